@@ -1,3 +1,7 @@
 from .database import *
 from .models import *
+from .allocator import *
 from .populate import *
+from .importers import *
+from .snapshot import *
+from .changefeed import *
@@ -0,0 +1,175 @@
+'''
+Client side allocation of ordinal paths for appending to ordered trees.
+
+OrdinalAllocator remembers the last ordinal handed out under recently used
+parents so that appending a child doesn't need the database to find a free
+slot. It follows the same stepping rules as oltree_free_path and falls back
+to that function when the cached gap runs out.
+'''
+import ltree_models
+
+from collections import OrderedDict
+from sqlalchemy import (
+    event,
+    literal,
+    select,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy_utils import (
+    LtreeType,
+    Ltree,
+)
+from .models import parent_path_of
+
+__all__ = (
+    'OrdinalAllocator',
+    'DEFAULT_MAX_PARENTS',
+)
+
+DEFAULT_MAX_PARENTS = 1024
+
+
+class OrdinalAllocator:
+    '''
+    LRU cache of the last used ordinal for each parent path.
+
+    Arguments:
+        node_class: model class using OLtreeMixin.
+        max_digits, step_digits, encoding: as passed to add_oltree_functions.
+            Default to the settings of node_class.
+        max_parents: number of parents to remember.
+        invalidate_on_commit: forget everything when an attached session
+            commits, so that slots taken by other processes are seen. Turn off
+            when this process is the only writer under the cached parents.
+
+    The cache is always cleared when an attached session rolls back, which is
+    what happens when a flush hits the unique constraint on path because
+    another writer took a cached slot. The next allocation under that parent
+    then looks at the database again. add() goes further and retries such a
+    flush itself, so the caller's transaction carries on.
+    '''
+
+    def __init__(
+        self, node_class,
+        max_digits=None,
+        step_digits=None,
+        encoding=None,
+        max_parents=DEFAULT_MAX_PARENTS,
+        invalidate_on_commit=True,
+    ):
+        self.Node = node_class
+        if max_digits is None:
+            max_digits = node_class.max_digits
+        if step_digits is None:
+            step_digits = node_class.step_digits
+        if encoding is None:
+            encoding = node_class.encoding
+        self.max_digits = max_digits
+        self.encoding = encoding
+        self.max_number, self.step_number = ltree_models.ordinal_limits(
+            max_digits, step_digits, encoding
+        )
+        self.max_parents = max_parents
+        self.invalidate_on_commit = invalidate_on_commit
+        self.last_ordinals = OrderedDict()
+
+    def attach(self, session):
+        '''
+        Invalidate the cache on the transaction events of session.
+        '''
+        if not event.contains(session, 'after_rollback', self.on_rollback):
+            event.listen(session, 'after_rollback', self.on_rollback)
+            if self.invalidate_on_commit:
+                event.listen(session, 'after_commit', self.on_commit)
+
+    def on_rollback(self, session):
+        self.invalidate()
+
+    def on_commit(self, session):
+        self.invalidate()
+
+    def invalidate(self, parent_path=None):
+        '''
+        Forget the cached gap for parent_path, or for every parent.
+        '''
+        if parent_path is None:
+            self.last_ordinals.clear()
+        else:
+            self.last_ordinals.pop(str(parent_path), None)
+
+    def last_ordinal(self, session, parent_path):
+        '''
+        Ordinal of the last child of parent_path in the database, or None.
+        '''
+        Node = self.Node
+        last = session.execute(
+            select(Node.path).where(
+                parent_path_of(Node.path) == literal(parent_path, LtreeType)
+            ).order_by(Node.path.desc()).limit(1)
+        ).scalar_one_or_none()
+        if last is None:
+            return None
+        return ltree_models.decode_ordinal(last, self.encoding)
+
+    def next_ordinal(self, last):
+        '''
+        Ordinal to use after last, or None if there is no room.
+
+        Same rules as oltree_noretry_free_path for __LAST__.
+        '''
+        # Halves are rounded up, as round() does in postgresql.
+        if last is None:
+            return (self.max_number + 1) // 2
+        if last >= self.max_number:
+            return None
+        if last == self.max_number - 1:
+            return self.max_number
+        halfway = (last + self.max_number + 1) // 2
+        return min(last + self.step_number, halfway)
+
+    def next_path(self, session, parent_path):
+        '''
+        Path for a new last child of parent_path.
+
+        Returns an Ltree, or a free_path() SQL expression when the cached gap
+        is used up (the database may then rebalance).
+        '''
+        self.attach(session)
+        key = str(parent_path)
+        if key in self.last_ordinals:
+            self.last_ordinals.move_to_end(key)
+            last = self.last_ordinals[key]
+        else:
+            last = self.last_ordinal(session, Ltree(key))
+        ordinal = self.next_ordinal(last)
+        if ordinal is None:
+            self.invalidate(key)
+            return self.Node.db_function('free_path')(Ltree(key) + '__LAST__')
+        self.last_ordinals[key] = ordinal
+        while len(self.last_ordinals) > self.max_parents:
+            self.last_ordinals.popitem(last=False)
+        return Ltree(key) + Ltree(ltree_models.encode_ordinal(
+            ordinal, self.max_digits, self.encoding
+        ))
+
+    def add(self, session, node, parent_path):
+        '''
+        Add node to session as a new last child of parent_path and flush it.
+
+        The flush runs in a savepoint. If another writer has taken the slot
+        the cache handed out, the savepoint is rolled back, the parent
+        forgotten, and node is flushed again at a path from free_path().
+        Returns node.
+        '''
+        node.path = self.next_path(session, parent_path)
+        try:
+            with session.begin_nested():
+                session.add(node)
+        except IntegrityError:
+            self.invalidate(parent_path)
+            node.path = self.Node.db_function('free_path')(
+                Ltree(str(parent_path)) + '__LAST__'
+            )
+            with session.begin_nested():
+                session.add(node)
+        return node
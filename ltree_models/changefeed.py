@@ -0,0 +1,193 @@
+'''
+Keep in memory tree snapshots up to date from a table's change log.
+
+add_change_feed() installs triggers which log every change to a table as a
+few events per statement: a moved subtree is one "move" event. SnapshotCache
+loads a TreeSnapshot once and then applies those events to it, reloading only
+when a change can't be applied incrementally.
+'''
+import select as select_module
+
+from collections import namedtuple
+from itertools import groupby
+from sqlalchemy import text
+from .database import (
+    change_log_name,
+    DEFAULT_POSTFIX,
+    DEFAULT_PREFIX,
+)
+from .snapshot import TreeSnapshot
+
+__all__ = (
+    'ChangeEvent',
+    'SnapshotCache',
+    'apply_changes',
+)
+
+ChangeEvent = namedtuple(
+    'ChangeEvent',
+    ('id', 'batch', 'op', 'old_path', 'new_path', 'node_id', 'node_name')
+)
+
+
+def apply_changes(snapshot, events):
+    '''
+    Apply change log events, in log order, to snapshot.
+
+    Events of one statement (batch) are applied together. Raises KeyError or
+    ValueError if the events don't fit the snapshot, or can't be applied
+    without a reload ("delete_node", gaps filled in below new nodes).
+    '''
+    for _, batch in groupby(events, key=lambda e: e.batch):
+        for op, group in groupby(batch, key=lambda e: e.op):
+            group = list(group)
+            if op == 'insert':
+                for e in group:
+                    snapshot.insert_node(e.new_path, e.node_id, e.node_name)
+            elif op == 'move':
+                snapshot.move_subtrees([(e.old_path, e.new_path) for e in group])
+            elif op == 'rename':
+                for e in group:
+                    snapshot.rename(e.new_path, e.node_name)
+            elif op == 'delete':
+                for e in group:
+                    snapshot.remove_subtree(e.old_path)
+            elif op == 'truncate':
+                snapshot = TreeSnapshot()
+            else:
+                raise ValueError(f'cannot apply {op} events.')
+    return snapshot
+
+
+class SnapshotCache:
+    '''
+    A TreeSnapshot of node_class's table kept up to date from its change log.
+
+    The change feed must have been installed with add_change_feed() using the
+    same prefix and postfix. snapshot is replaced, never changed, so readers
+    can keep using the one they have.
+
+    Arguments:
+        engine: engine to read the database with.
+        node_class: model class of the table.
+        prefix, postfix: as passed to add_change_feed().
+        channel: as passed to add_change_feed().
+    '''
+
+    def __init__(
+        self, engine, node_class,
+        prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+        channel=None,
+    ):
+        self.engine = engine
+        self.Node = node_class
+        self.log_name = change_log_name(
+            full_table_name=node_class.__table__.fullname,
+            prefix=prefix, postfix=postfix
+        )
+        self.channel = channel or self.log_name
+        self.snapshot = None
+        # Transaction snapshot (txid_snapshot text) the snapshot is up to.
+        self.seen = None
+        self.listener = None
+
+    def repeatable_read(self):
+        return self.engine.connect().execution_options(
+            isolation_level='REPEATABLE READ'
+        )
+
+    def current_snapshot(self, con):
+        return con.execute(
+            text('SELECT txid_current_snapshot()::text')
+        ).scalar_one()
+
+    def load(self):
+        '''
+        Load the whole snapshot, and which transactions it includes.
+        '''
+        with self.repeatable_read() as con:
+            with con.begin():
+                seen = self.current_snapshot(con)
+                self.snapshot = TreeSnapshot.load(con, self.Node)
+                self.seen = seen
+        return self.snapshot
+
+    def changes(self):
+        '''
+        Events not yet applied, in order, and the snapshot they go up to.
+
+        These are the events of transactions which have committed since the
+        last read: visible now but not in seen. Events of transactions still
+        in progress are left for a later read.
+        '''
+        with self.repeatable_read() as con:
+            with con.begin():
+                now = self.current_snapshot(con)
+                events = [
+                    ChangeEvent(*row) for row in con.execute(
+                        text(f'''
+SELECT id, batch, op, old_path, new_path, node_id, node_name
+FROM {self.log_name}
+WHERE txid >= txid_snapshot_xmin(CAST(:seen AS txid_snapshot))
+AND NOT txid_visible_in_snapshot(txid, CAST(:seen AS txid_snapshot))
+AND txid_visible_in_snapshot(txid, CAST(:now AS txid_snapshot))
+ORDER BY batch, id
+'''),
+                        {'seen': self.seen, 'now': now}
+                    )
+                ]
+        return events, now
+
+    def refresh(self):
+        '''
+        Bring snapshot up to date, returning the number of events applied.
+
+        Loads the snapshot the first time, and whenever the events can't be
+        applied incrementally. Returns None when it loaded.
+        '''
+        if self.snapshot is None:
+            self.load()
+            return None
+        events, now = self.changes()
+        if not events:
+            self.seen = now
+            return 0
+        try:
+            snapshot = apply_changes(self.snapshot.copy(), events)
+        except (KeyError, ValueError):
+            self.load()
+            return None
+        self.snapshot = snapshot
+        self.seen = now
+        return len(events)
+
+    def wait(self, timeout=None):
+        '''
+        Wait up to timeout seconds for a change notification, then refresh().
+
+        Uses LISTEN on a connection of its own, so needs psycopg2. Returns what
+        refresh() returns, or 0 on timeout.
+        '''
+        if self.listener is None:
+            self.listener = self.engine.raw_connection()
+            self.listener.connection.autocommit = True
+            with self.listener.cursor() as cur:
+                cur.execute(f'LISTEN "{self.channel}"')
+            # Changes may have come in before we listened.
+            applied = self.refresh()
+            if applied != 0:
+                return applied
+        con = self.listener.connection
+        con.poll()
+        if not con.notifies:
+            ready, _, _ = select_module.select([con], [], [], timeout)
+            if not ready:
+                return 0
+            con.poll()
+        con.notifies.clear()
+        return self.refresh()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
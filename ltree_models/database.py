@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 from sqlalchemy import (
     text,
 )
@@ -7,17 +10,47 @@ DEFAULT_POSTFIX = None
 DEFAULT_TABLE_NAME = 'nodes'
 DEFAULT_MAX_DIGITS = 16
 DEFAULT_STEP_DIGITS = 8
+DEFAULT_NAME_PATH_SEP = '/'
+DEFAULT_REBALANCE = 'local'
+DEFAULT_ENCODING = 'decimal'
+METADATA_TABLE = 'ltree_models_installed'
+
+# Label alphabets in ltree (byte) order. '_' is left out so that labels can't
+# collide with the __FIRST__ and __LAST__ markers.
+ENCODINGS = {
+    'decimal': '0123456789',
+    'base36': '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+    'base62': (
+        '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    ),
+}
 
 __all__ = (
     'add_ltree_extension',
     'add_oltree_functions',
+    'add_name_path_triggers',
+    'add_change_feed',
+    'change_log_name',
+    'prune_change_log',
+    'install',
+    'installed_params',
+    'run_rebalancer',
     'free_path_text',
     'rebalance_text',
+    'rebalance_gap_text',
     'DEFAULT_PREFIX',
     'DEFAULT_POSTFIX',
     'DEFAULT_TABLE_NAME',
     'DEFAULT_MAX_DIGITS',
     'DEFAULT_STEP_DIGITS',
+    'DEFAULT_NAME_PATH_SEP',
+    'DEFAULT_REBALANCE',
+    'DEFAULT_ENCODING',
+    'METADATA_TABLE',
+    'ENCODINGS',
+    'encode_ordinal',
+    'decode_ordinal',
+    'ordinal_limits',
 )
 
 
@@ -46,26 +79,142 @@ def add_ltree_extension(engine):
         con.execute(text("CREATE EXTENSION IF NOT EXISTS ltree;"))
 
 
+def encoding_alphabet(encoding=DEFAULT_ENCODING):
+    try:
+        return ENCODINGS[encoding]
+    except KeyError:
+        raise ValueError(f'unknown encoding {encoding!r}.') from None
+
+
+def ordinal_limits(max_digits, step_digits, encoding=DEFAULT_ENCODING):
+    '''
+    The largest ordinal and the append step for an encoding, as (max, step).
+    '''
+    base = len(encoding_alphabet(encoding))
+    return base ** max_digits - 1, base ** step_digits
+
+
+def encode_ordinal(n, max_digits, encoding=DEFAULT_ENCODING):
+    '''
+    Label for ordinal n, padded to max_digits characters so that labels sort
+    in ordinal order.
+    '''
+    alphabet = encoding_alphabet(encoding)
+    base = len(alphabet)
+    if not 0 <= n < base ** max_digits:
+        raise ValueError(
+            f'{n} does not fit in {max_digits} {encoding} digits.'
+        )
+    chars = []
+    for _ in range(max_digits):
+        n, digit = divmod(n, base)
+        chars.append(alphabet[digit])
+    return ''.join(reversed(chars))
+
+
+def decode_ordinal(label, encoding=DEFAULT_ENCODING):
+    '''
+    Ordinal of a label (or of the last label of a path).
+    '''
+    alphabet = encoding_alphabet(encoding)
+    base = len(alphabet)
+    n = 0
+    for char in str(label).split('.')[-1]:
+        n = n * base + alphabet.index(char)
+    return n
+
+
+def labels_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+):
+    '''
+    Text defining the functions which convert between ordinals and labels.
+
+    label(n) returns the label for ordinal n padded to max_digits characters.
+    ordinal(path) returns the ordinal of the last label of path, which need not
+    be padded. All the other functions go through these two.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        max_digits: maximum number of digits in the number associated with each
+            node at each path level.
+        step_digits: number of digits to use as the step when inserting children
+            at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
+    '''
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    alphabet = encoding_alphabet(encoding)
+    base = len(alphabet)
+    if encoding == 'decimal':
+        format_text = 'FM' + '0' * max_digits
+        label_sql = f"SELECT to_char(n, '{format_text}')::ltree"
+        ordinal_sql = 'SELECT subpath(path, -1)::text::numeric'
+    else:
+        label_sql = f'''SELECT string_agg(
+    substr('{alphabet}', mod(div(n, {base}::numeric ^ i), {base})::int + 1, 1),
+    '' ORDER BY i DESC
+)::ltree
+FROM generate_series(0, {max_digits} - 1) AS i'''
+        ordinal_sql = f'''SELECT sum(
+    (strpos('{alphabet}', substr(l.label, i, 1)) - 1)
+    * {base}::numeric ^ (length(l.label) - i)
+)
+FROM (SELECT ltree2text(subpath(path, -1)) AS label) AS l,
+    generate_series(1, length(l.label)) AS i'''
+    return text(f'''
+CREATE OR REPLACE FUNCTION public.{label_name}(n numeric)
+    RETURNS ltree
+    LANGUAGE sql IMMUTABLE STRICT
+AS $function$
+{label_sql}
+$function$;
+CREATE OR REPLACE FUNCTION public.{ordinal_name}(path ltree)
+    RETURNS numeric
+    LANGUAGE sql IMMUTABLE STRICT
+AS $function$
+{ordinal_sql}
+$function$;
+''')
+
+
 def noretry_free_path_parent_sibling_text(
     table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
     prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
     max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
 ):
     '''
     Text defining a database function which returns the next free path without retries.
 
     Arguments:
         table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
         prefix: prefix to add to all names (table, function, etc.)
         postfix: postfix to add to all names (table, function, etc.)
         max_digits: maximum number of digits in the number associated with each
             node at each path level.
         step_digits: number of digits to use as the step when inserting children
             at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
     '''
-    table_name = wrap_name(table_name, prefix=prefix, postfix=postfix)
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
     func_name = wrap_name('noretry_free_path_parent_sibling', prefix=prefix, postfix=postfix)
-    format_text = 'FM' + '0' * max_digits
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
     return text(f'''
 CREATE OR REPLACE FUNCTION public.{func_name}(parent ltree, after ltree DEFAULT NULL::ltree)
     RETURNS ltree
@@ -77,8 +226,8 @@ DECLARE
     before ltree := NULL::ltree;
     before_pos numeric := NULL;
     next_pos numeric := NULL;
-    big_step_pos numeric := 1e{step_digits};
-    max_pos numeric := 1e{max_digits} - 1;
+    big_step_pos numeric := {step_pos};
+    max_pos numeric := {max_pos};
 BEGIN
 IF NOT (
     after IS NULL OR after = '__LAST__' OR after = '__FIRST__' OR
@@ -106,7 +255,7 @@ ELSEIF after = '__FIRST__' THEN
 ELSE
     -- Make sure after has the correct number of digits so that lexical sorting
     -- works.
-    -- after := parent || to_char(after_pos, '{format_text}')::ltree;
+    -- after := parent || {label_name}(after_pos);
     before := path from {table_name}
     WHERE parent @> path AND parent_level = (nlevel(path) - 1) AND path > after
     ORDER BY path
@@ -114,7 +263,7 @@ ELSE
 END IF;
 -- RAISE NOTICE 'after: %, before: %', after, before;
 IF after IS NOT NULL THEN
-    after_pos := subpath(after, -1)::text::numeric;
+    after_pos := {ordinal_name}(subpath(after, -1));
 END IF;
 IF after IS NULL AND before IS NULL THEN
     -- There are no child nodes of parent. Choose half way between top of range and 0.
@@ -138,7 +287,7 @@ ELSEIF before IS NULL THEN
     END IF;
 ELSEIF after IS NULL THEN
     -- Find a spot before before.
-    before_pos = subpath(before, -1)::text::numeric;
+    before_pos = {ordinal_name}(subpath(before, -1));
     IF before_pos = 0 THEN
         RAISE EXCEPTION 'Out of space before %', before
         USING ERRCODE = 'indicator_overflow';
@@ -154,14 +303,14 @@ ELSEIF after IS NULL THEN
     END IF;
 ELSE
     -- Find a spot between after and before.
-    before_pos := subpath(before, -1)::text::numeric;
+    before_pos := {ordinal_name}(subpath(before, -1));
     next_pos := round((after_pos + before_pos)/2);
     IF next_pos = after_pos OR next_pos = before_pos THEN
         RAISE EXCEPTION 'Out of space between % and %', after, before
         USING ERRCODE = 'indicator_overflow';
     END IF;
 END IF;
-RETURN parent || to_char(next_pos, '{format_text}')::ltree;
+RETURN parent || {label_name}(next_pos);
 END;
 $function$
 ''')
@@ -169,24 +318,33 @@ $function$
 
 def noretry_free_path_text(
     table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
     prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
     max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
 ):
     '''
     Text defining a database function which returns the next free path after a node.
 
     Arguments:
         table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
         prefix: prefix to add to all names (table, function, etc.)
         postfix: postfix to add to all names (table, function, etc.)
         max_digits: maximum number of digits in the number associated with each
             node at each path level.
         step_digits: number of digits to use as the step when inserting children
             at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
     '''
-    table_name = wrap_name(table_name, prefix=prefix, postfix=postfix)
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
     func_name = wrap_name('noretry_free_path', prefix=prefix, postfix=postfix)
-    format_text = 'FM' + '0' * max_digits
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
     return text(f'''
 CREATE OR REPLACE FUNCTION public.{func_name}(after ltree)
     RETURNS ltree
@@ -200,8 +358,8 @@ DECLARE
     before ltree := NULL::ltree;
     before_pos numeric := NULL;
     next_pos numeric := NULL;
-    big_step_pos numeric := 1e{step_digits};
-    max_pos numeric := 1e{max_digits} - 1;
+    big_step_pos numeric := {step_pos};
+    max_pos numeric := {max_pos};
     found_parent ltree := NULL::ltree;
     -- To be used if it is decided to treat non existant after node as an error.
     -- found_after ltree := NULL::ltree;
@@ -233,8 +391,8 @@ ELSEIF after_leaf = '__FIRST__' THEN
 ELSE
     -- Make sure after has the correct number of digits so that lexical sorting
     -- works.
-    after_pos := subpath(after, -1)::text::numeric;
-    after := parent || to_char(after_pos, '{format_text}')::ltree;
+    after_pos := {ordinal_name}(subpath(after, -1));
+    after := parent || {label_name}(after_pos);
     before := path from {table_name}
     WHERE parent @> path AND parent_level = (nlevel(path) - 1) AND path > after
     ORDER BY path
@@ -242,7 +400,7 @@ ELSE
 END IF;
 -- RAISE NOTICE 'after: %, before: %', after, before;
 IF after IS NOT NULL THEN
-    after_pos := subpath(after, -1)::text::numeric;
+    after_pos := {ordinal_name}(subpath(after, -1));
 END IF;
 IF after IS NULL AND before IS NULL THEN
     -- There are no child nodes of parent. Choose half way between top of range and 0.
@@ -266,7 +424,7 @@ ELSEIF before IS NULL THEN
     END IF;
 ELSEIF after IS NULL THEN
     -- Find a spot before before.
-    before_pos = subpath(before, -1)::text::numeric;
+    before_pos = {ordinal_name}(subpath(before, -1));
     IF before_pos = 0 THEN
         RAISE EXCEPTION 'Out of space before %', before
         USING ERRCODE = 'indicator_overflow';
@@ -282,14 +440,14 @@ ELSEIF after IS NULL THEN
     END IF;
 ELSE
     -- Find a spot between after and before.
-    before_pos := subpath(before, -1)::text::numeric;
+    before_pos := {ordinal_name}(subpath(before, -1));
     next_pos := round((after_pos + before_pos)/2);
     IF next_pos = after_pos OR next_pos = before_pos THEN
         RAISE EXCEPTION 'Out of space between % and %', after, before
         USING ERRCODE = 'indicator_overflow';
     END IF;
 END IF;
-RETURN parent || to_char(next_pos, '{format_text}')::ltree;
+RETURN parent || {label_name}(next_pos);
 END;
 $function$
 ''')
@@ -297,37 +455,53 @@ $function$
 
 def rebalance_text(
     table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
     prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
     max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
 ):
     '''
     Text defining a database function which rebalances the ordinals of the children of a node.
 
+    Every child of parent is renumbered evenly through the ordinal range and
+    its subtree is moved with it, all in one UPDATE. Any paths passed in
+    follow (an ltree[]) are set to where they moved.
+
     Arguments:
         table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
         prefix: prefix to add to all names (table, function, etc.)
         postfix: postfix to add to all names (table, function, etc.)
         max_digits: maximum number of digits in the number associated with each
             node at each path level.
         step_digits: number of digits to use as the step when inserting children
             at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
     '''
 
-    table_name = wrap_name(table_name, prefix=prefix, postfix=postfix)
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
     func_name = wrap_name('rebalance', prefix=prefix, postfix=postfix)
-    format_text = 'FM' + '0' * max_digits
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
     return text(f'''
-CREATE OR REPLACE PROCEDURE public.{func_name}(parent ltree)
+DROP PROCEDURE IF EXISTS public.{func_name}(ltree);
+CREATE OR REPLACE PROCEDURE public.{func_name}(
+    parent ltree, INOUT follow ltree[] DEFAULT NULL
+)
     LANGUAGE plpgsql
 AS $procedure$
 DECLARE
     parent_level int := nlevel(parent);
-    max_pos numeric := 1e{max_digits} - 1;
+    max_pos numeric := {max_pos};
     step numeric;
     n_children numeric := 1;
 BEGIN
-n_children := COUNT(*) FROM {table_name}
-    WHERE parent @> path and parent_level = nlevel(path) - 1;
+n_children := COUNT(*) FROM {table_name} c
+    WHERE subpath(c.path, 0, -1) = parent;
 step := ((max_pos + 1) / (n_children + 1));
 RAISE NOTICE 'children % / %, step: %', n_children, (max_pos), step;
 IF step <= 1.0::numeric THEN
@@ -336,56 +510,635 @@ IF step <= 1.0::numeric THEN
 END IF;
 WITH ordinals AS (
     SELECT
-        row_number() OVER (ORDER BY path) as row,
-        path
-    FROM {table_name}
-    WHERE parent @> path and parent_level = nlevel(path) - 1
+        row_number() OVER (ORDER BY c.path) as row,
+        c.path AS old_path
+    FROM {table_name} c
+    WHERE subpath(c.path, 0, -1) = parent
+), moved AS (
+    SELECT
+        old_path,
+        parent || {label_name}(round(ordinals.row * step)) AS new_path
+    FROM ordinals
+), updated AS (
+    UPDATE {table_name} AS t
+    SET path = CASE
+        WHEN t.path = m.old_path THEN m.new_path
+        ELSE m.new_path || subpath(t.path, parent_level + 1)
+    END
+    FROM moved AS m
+    WHERE t.path <@ m.old_path AND m.old_path <> m.new_path
+)
+SELECT ARRAY(
+    SELECT CASE
+        WHEN m.old_path IS NULL THEN f.path
+        WHEN f.path = m.old_path THEN m.new_path
+        ELSE m.new_path || subpath(f.path, parent_level + 1)
+    END
+    FROM unnest(follow) WITH ORDINALITY AS f(path, i)
+    LEFT JOIN moved AS m ON m.old_path @> f.path
+    ORDER BY f.i
+) INTO follow;
+END;
+$procedure$
+''')
+
+
+def rebalance_gap_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+    rebalance=DEFAULT_REBALANCE,
+):
+    '''
+    Text defining a database procedure which makes room for new nodes after a node.
+
+    The procedure takes "after" (a child path, parent.__FIRST__ or
+    parent.__LAST__) and the number of free ordinals needed there. This is what
+    the free path functions call when a gap is full. after is set to where the
+    gap now starts, so callers don't have to look it up again, and any paths
+    passed in follow (an ltree[]) are set to where they moved.
+
+    With rebalance='local' only a window of ordinals around the gap is
+    renumbered, as in list labelling algorithms: starting from a window a little
+    bigger than the gap needs, aligned windows are doubled in size until one is
+    at most half full, and only the siblings inside that window are spread out.
+    The subtree of every renumbered sibling moves with it in the same UPDATE.
+    With rebalance='full' the procedure calls the rebalance procedure on the
+    parent.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        max_digits: maximum number of digits in the number associated with each
+            node at each path level.
+        step_digits: number of digits to use as the step when inserting children
+            at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
+        rebalance: 'local' or 'full'.
+    '''
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    func_name = wrap_name('rebalance_gap', prefix=prefix, postfix=postfix)
+    rebalance_name = wrap_name('rebalance', prefix=prefix, postfix=postfix)
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
+    if rebalance == 'full':
+        # Every sibling is renumbered, so finding after again by its rank
+        # costs no more than the rebalance itself.
+        return text(f'''
+DROP PROCEDURE IF EXISTS public.{func_name}(ltree, int);
+CREATE OR REPLACE PROCEDURE public.{func_name}(
+    INOUT after ltree, need int DEFAULT 1, INOUT follow ltree[] DEFAULT NULL
+)
+    LANGUAGE plpgsql
+AS $procedure$
+DECLARE
+    parent ltree := subpath(after, 0, -1);
+    leaf ltree := subpath(after, -1);
+    after_rank bigint;
+BEGIN
+IF leaf NOT IN ('__FIRST__', '__LAST__') THEN
+    after := parent || {label_name}({ordinal_name}(leaf));
+    after_rank := count(*) FROM {table_name} t
+        WHERE subpath(t.path, 0, -1) = parent AND t.path <= after;
+END IF;
+CALL {rebalance_name}(parent, follow);
+IF after_rank = 0 THEN
+    after := parent || '__FIRST__'::ltree;
+ELSIF after_rank IS NOT NULL THEN
+    after := t.path FROM {table_name} t
+        WHERE subpath(t.path, 0, -1) = parent
+        ORDER BY t.path OFFSET after_rank - 1 LIMIT 1;
+END IF;
+END;
+$procedure$
+''')
+    if rebalance != 'local':
+        raise ValueError(f'unknown rebalance strategy {rebalance!r}.')
+    return text(f'''
+DROP PROCEDURE IF EXISTS public.{func_name}(ltree, int);
+CREATE OR REPLACE PROCEDURE public.{func_name}(
+    INOUT after ltree, need int DEFAULT 1, INOUT follow ltree[] DEFAULT NULL
+)
+    LANGUAGE plpgsql
+AS $procedure$
+DECLARE
+    parent ltree := subpath(after, 0, -1);
+    parent_level int := nlevel(parent);
+    leaf ltree := subpath(after, -1);
+    max_pos numeric := {max_pos};
+    pos numeric;
+    width numeric := 2 * (need + 1);
+    lo numeric;
+    hi numeric;
+    n_window bigint;
+BEGIN
+IF leaf = '__FIRST__' THEN
+    pos := {ordinal_name}(subpath(c.path, -1)) FROM {table_name} c
+        WHERE subpath(c.path, 0, -1) = parent
+        ORDER BY c.path LIMIT 1;
+ELSIF leaf = '__LAST__' THEN
+    pos := {ordinal_name}(subpath(c.path, -1)) FROM {table_name} c
+        WHERE subpath(c.path, 0, -1) = parent
+        ORDER BY c.path DESC LIMIT 1;
+ELSE
+    pos := {ordinal_name}(leaf);
+    after := parent || {label_name}(pos);
+END IF;
+IF pos IS NULL THEN
+    -- No children, so nothing to make room between.
+    RETURN;
+END IF;
+-- Find the smallest aligned window around pos which is at most half full
+-- once the new nodes are counted. The whole range only has to fit them.
+LOOP
+    lo := floor(pos / width) * width;
+    hi := least(lo + width - 1, max_pos);
+    n_window := count(*) FROM {table_name} c
+        WHERE c.path >= parent || {label_name}(lo)
+        AND c.path <= parent || {label_name}(hi)
+        AND nlevel(c.path) = parent_level + 1;
+    IF lo = 0 AND hi = max_pos THEN
+        IF n_window + need + 1 > max_pos + 1 THEN
+            RAISE EXCEPTION 'out of space rebalancing %', parent
+            USING ERRCODE = 'indicator_overflow';
+        END IF;
+        EXIT;
+    END IF;
+    EXIT WHEN 2 * (n_window + need) <= hi - lo + 1;
+    width := width * 2;
+END LOOP;
+-- Spread the siblings in the window evenly, leaving need empty slots after
+-- "after", and carry each sibling's subtree along. Where after and the
+-- followed paths went is read from the window alone.
+WITH ranked AS (
+    SELECT
+        c.path AS old_path,
+        row_number() OVER (ORDER BY c.path) + CASE
+            WHEN leaf = '__FIRST__' THEN need
+            WHEN leaf = '__LAST__' THEN 0
+            WHEN c.path > after THEN need
+            ELSE 0
+        END AS rank
+    FROM {table_name} c
+    WHERE c.path >= parent || {label_name}(lo)
+    AND c.path <= parent || {label_name}(hi)
+    AND nlevel(c.path) = parent_level + 1
+), moved AS (
+    SELECT
+        old_path,
+        parent || {label_name}(
+            lo + floor((hi - lo + 1) * rank / (n_window + need + 1))
+        ) AS new_path
+    FROM ranked
+), updated AS (
+    UPDATE {table_name} AS t
+    SET path = CASE
+        WHEN t.path = m.old_path THEN m.new_path
+        ELSE m.new_path || subpath(t.path, parent_level + 1)
+    END
+    FROM moved AS m
+    WHERE t.path <@ m.old_path AND m.old_path <> m.new_path
 )
-UPDATE {table_name}
-SET
-    path = parent || to_char(
-        round(ordinals.row * step), '{format_text}'
-    )::ltree
-FROM ordinals
-WHERE oltree_nodes.path = ordinals.path;
+SELECT
+    CASE
+        WHEN leaf IN ('__FIRST__', '__LAST__') THEN after
+        -- The last sibling up to after, or the (free) start of the window.
+        ELSE coalesce(
+            (
+                SELECT m.new_path FROM moved AS m
+                WHERE m.old_path <= after
+                ORDER BY m.old_path DESC LIMIT 1
+            ),
+            parent || {label_name}(lo)
+        )
+    END,
+    ARRAY(
+        SELECT CASE
+            WHEN m.old_path IS NULL THEN f.path
+            WHEN f.path = m.old_path THEN m.new_path
+            ELSE m.new_path || subpath(f.path, parent_level + 1)
+        END
+        FROM unnest(follow) WITH ORDINALITY AS f(path, i)
+        LEFT JOIN moved AS m ON m.old_path @> f.path
+        ORDER BY f.i
+    )
+INTO after, follow;
 END;
 $procedure$
 ''')
 
 
+def gap_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+):
+    '''
+    Text defining a database function which returns the free gap after a node.
+
+    The function returns the ordinals (lo, hi) bounding the gap after
+    "after" (which may be parent.__FIRST__ or parent.__LAST__): every ordinal
+    strictly between them is free. lo is -1 and hi is one more than the
+    largest ordinal when there is no bounding sibling.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        max_digits: maximum number of digits in the number associated with each
+            node at each path level.
+        step_digits: number of digits to use as the step when inserting children
+            at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
+    '''
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    func_name = wrap_name('gap', prefix=prefix, postfix=postfix)
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
+    return text(f'''
+CREATE OR REPLACE FUNCTION public.{func_name}(
+    after ltree, OUT lo numeric, OUT hi numeric
+)
+    LANGUAGE plpgsql
+    STABLE
+AS $function$
+DECLARE
+    parent ltree := subpath(after, 0, -1);
+    leaf ltree := subpath(after, -1);
+    max_pos numeric := {max_pos};
+BEGIN
+IF leaf = '__FIRST__' THEN
+    lo := -1;
+    hi := {ordinal_name}(subpath(t.path, -1)) FROM {table_name} t
+        WHERE subpath(t.path, 0, -1) = parent
+        ORDER BY t.path LIMIT 1;
+ELSIF leaf = '__LAST__' THEN
+    lo := {ordinal_name}(subpath(t.path, -1)) FROM {table_name} t
+        WHERE subpath(t.path, 0, -1) = parent
+        ORDER BY t.path DESC LIMIT 1;
+    hi := NULL;
+ELSE
+    lo := {ordinal_name}(leaf);
+    hi := {ordinal_name}(subpath(t.path, -1)) FROM {table_name} t
+        WHERE subpath(t.path, 0, -1) = parent
+        AND t.path > parent || {label_name}(lo)
+        ORDER BY t.path LIMIT 1;
+END IF;
+lo := coalesce(lo, -1);
+hi := coalesce(hi, max_pos + 1);
+END;
+$function$
+''')
+
+
+def free_paths_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+):
+    '''
+    Text defining a database function which returns n free paths after a node.
+
+    The paths are spread evenly through the gap between "after" and its next
+    sibling (or at parent.__FIRST__/parent.__LAST__). If the gap is too small
+    the parent is rebalanced once and the gap after the same sibling is used.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        max_digits: maximum number of digits in the number associated with each
+            node at each path level.
+        step_digits: number of digits to use as the step when inserting children
+            at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
+    '''
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    func_name = wrap_name('free_paths', prefix=prefix, postfix=postfix)
+    rebalance_name = wrap_name('rebalance_gap', prefix=prefix, postfix=postfix)
+    gap_name = wrap_name('gap', prefix=prefix, postfix=postfix)
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
+    return text(f'''
+CREATE OR REPLACE FUNCTION public.{func_name}(after ltree, n int)
+    RETURNS SETOF ltree
+    LANGUAGE plpgsql
+AS $function$
+DECLARE
+    parent ltree := subpath(after, 0, -1);
+    leaf ltree := subpath(after, -1);
+    is_marker boolean := leaf IN ('__FIRST__', '__LAST__');
+    follow ltree[];
+    lo numeric;
+    hi numeric;
+BEGIN
+IF nlevel(parent) < 1 THEN
+    RAISE EXCEPTION
+    '"%" is not a child node: can''t assign as sibling of root.', after;
+END IF;
+IF NOT EXISTS (SELECT 1 FROM {table_name} t WHERE t.path = parent) THEN
+    RAISE EXCEPTION 'parent "%" does not exist.', parent;
+END IF;
+IF n < 1 THEN
+    RETURN;
+END IF;
+IF NOT is_marker THEN
+    after := parent || {label_name}({ordinal_name}(leaf));
+END IF;
+FOR attempt IN 1..2 LOOP
+    SELECT g.lo, g.hi INTO lo, hi FROM {gap_name}(after) AS g;
+    EXIT WHEN hi - lo >= n + 1;
+    IF attempt = 2 THEN
+        RAISE EXCEPTION 'Out of space for % nodes after %', n, after
+        USING ERRCODE = 'indicator_overflow';
+    END IF;
+    RAISE NOTICE 'rebalancing %', parent;
+    -- Sets after to where the gap now starts.
+    CALL {rebalance_name}(after, n, follow);
+END LOOP;
+RETURN QUERY
+    SELECT parent || {label_name}(lo + floor((hi - lo) * j / (n + 1)))
+    FROM generate_series(1, n) AS j;
+END;
+$function$
+''')
+
+
+def move_targets_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+):
+    '''
+    Text defining a database function which allocates paths for a batch of moves.
+
+    The function takes an array of source paths and an array of "after" paths
+    (as accepted by free_path, including parent.__FIRST__ and
+    parent.__LAST__) and returns (move_idx, move_source, move_path,
+    rebalanced) rows, move_idx being the 1 based position in the arrays. Moves
+    into the same gap (after the same node, or after the last child and
+    __LAST__) are spread evenly through it, in array order.
+
+    Room is made with the rebalance_gap procedure when a gap is too small,
+    before any path is allocated. If the same parent runs short again (room made
+    for one gap can take it from another) the whole parent is rebalanced, once.
+    move_source is the path of the source after any such rebalance, and
+    rebalanced (the same in every row) lists the parents whose children were
+    renumbered.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        max_digits: maximum number of digits in the number associated with each
+            node at each path level.
+        step_digits: number of digits to use as the step when inserting children
+            at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
+    '''
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    func_name = wrap_name('move_targets', prefix=prefix, postfix=postfix)
+    rebalance_name = wrap_name('rebalance', prefix=prefix, postfix=postfix)
+    rebalance_gap_name = wrap_name('rebalance_gap', prefix=prefix, postfix=postfix)
+    gap_name = wrap_name('gap', prefix=prefix, postfix=postfix)
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
+    return text(f'''
+DROP FUNCTION IF EXISTS public.{func_name}(ltree[], ltree[]);
+CREATE OR REPLACE FUNCTION public.{func_name}(sources ltree[], afters ltree[])
+    RETURNS TABLE(
+        move_idx int, move_source ltree, move_path ltree, rebalanced ltree[]
+    )
+    LANGUAGE plpgsql
+AS $function$
+DECLARE
+    n int := cardinality(afters);
+    srcs ltree[] := sources;
+    norm ltree[] := afters;
+    follow ltree[];
+    localised ltree[] := ARRAY[]::ltree[];
+    done ltree[] := ARRAY[]::ltree[];
+    grp record;
+    short_after ltree;
+    short_by int;
+    parent ltree;
+    leaf ltree;
+    lo numeric;
+    hi numeric;
+    j int;
+    max_pos numeric := {max_pos};
+BEGIN
+IF cardinality(sources) <> n THEN
+    RAISE EXCEPTION 'sources and afters must be the same length';
+END IF;
+-- Normalise afters: markers stay as they are, sibling ordinals are padded
+-- so that lexical sorting works, and an ordinal with no node is replaced by
+-- the sibling before it (or __FIRST__), which names the same gap and can be
+-- followed through a rebalance.
+FOR i IN 1..n LOOP
+    parent := subpath(afters[i], 0, -1);
+    leaf := subpath(afters[i], -1);
+    IF nlevel(parent) < 1 THEN
+        RAISE EXCEPTION
+        '"%" is not a child node: can''t assign as sibling of root.', afters[i];
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM {table_name} t WHERE t.path = parent) THEN
+        RAISE EXCEPTION 'parent "%" does not exist.', parent;
+    END IF;
+    IF leaf NOT IN ('__FIRST__', '__LAST__') THEN
+        norm[i] := parent || {label_name}({ordinal_name}(leaf));
+        IF NOT EXISTS (SELECT 1 FROM {table_name} t WHERE t.path = norm[i]) THEN
+            norm[i] := coalesce(
+                (
+                    SELECT t.path FROM {table_name} t
+                    WHERE subpath(t.path, 0, -1) = parent AND t.path < norm[i]
+                    ORDER BY t.path DESC LIMIT 1
+                ),
+                parent || '__FIRST__'::ltree
+            );
+        END IF;
+    END IF;
+END LOOP;
+-- Rebalance any parent with a gap too small for the nodes moving into it.
+LOOP
+    short_after := NULL;
+    FOR grp IN
+        SELECT (array_agg(a.after))[1] AS after, g.lo, g.hi, count(*) AS k
+        FROM unnest(norm) AS a(after), {gap_name}(a.after) AS g
+        GROUP BY subpath(a.after, 0, -1), g.lo, g.hi
+    LOOP
+        IF grp.hi - grp.lo < grp.k + 1 THEN
+            short_after := grp.after;
+            short_by := grp.k;
+            EXIT;
+        END IF;
+    END LOOP;
+    EXIT WHEN short_after IS NULL;
+    parent := subpath(short_after, 0, -1);
+    IF parent = ANY(done) THEN
+        RAISE EXCEPTION 'Out of space moving nodes into %', parent
+        USING ERRCODE = 'indicator_overflow';
+    END IF;
+    RAISE NOTICE 'rebalancing %', parent;
+    -- Sources and afters below parent move with the renumbered siblings:
+    -- the rebalance procedures say where.
+    follow := srcs || norm;
+    IF parent = ANY(localised) THEN
+        CALL {rebalance_name}(parent, follow);
+        done := array_append(done, parent);
+    ELSE
+        CALL {rebalance_gap_name}(short_after, short_by, follow);
+        localised := array_append(localised, parent);
+    END IF;
+    srcs := follow[1:n];
+    norm := follow[n + 1:2 * n];
+END LOOP;
+-- Every gap is now big enough: spread each group evenly through its gap.
+-- Different afters may name the same gap, so group by the gap itself.
+FOR grp IN
+    SELECT subpath(a.after, 0, -1) AS parent, g.lo, g.hi,
+        array_agg(a.idx ORDER BY a.idx) AS idxs
+    FROM unnest(norm) WITH ORDINALITY AS a(after, idx), {gap_name}(a.after) AS g
+    GROUP BY subpath(a.after, 0, -1), g.lo, g.hi
+LOOP
+    parent := grp.parent;
+    lo := grp.lo;
+    hi := grp.hi;
+    FOR j IN 1..cardinality(grp.idxs) LOOP
+        move_idx := grp.idxs[j];
+        move_source := srcs[move_idx];
+        rebalanced := localised;
+        move_path := parent || {label_name}(
+            lo + floor((hi - lo) * j / (cardinality(grp.idxs) + 1))
+        );
+        RETURN NEXT;
+    END LOOP;
+END LOOP;
+END;
+$function$
+''')
+
+
+def queue_parent_text(
+    after_sql,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    queue_min_gap=None,
+):
+    '''
+    plpgsql statements which queue the gap after after_sql for rebalancing.
+
+    The gap is queued when it has fewer than queue_min_gap free ordinals
+    (after_sql is an ltree expression as accepted by the gap function). Only
+    one gap per parent is queued at a time. Returns an empty string if
+    queue_min_gap is None.
+    '''
+    if queue_min_gap is None:
+        return ''
+    queue_name = wrap_name('rebalance_queue', prefix=prefix, postfix=postfix)
+    gap_name = wrap_name('gap', prefix=prefix, postfix=postfix)
+    return f'''
+IF (SELECT g.hi - g.lo - 1 FROM {gap_name}({after_sql}) AS g) < {int(queue_min_gap)}
+    AND NOT EXISTS (
+        SELECT 1 FROM {queue_name} q WHERE q.parent = subpath({after_sql}, 0, -1)
+    ) THEN
+    INSERT INTO {queue_name} (parent, after)
+    VALUES (subpath({after_sql}, 0, -1), {after_sql})
+    ON CONFLICT DO NOTHING;
+END IF;'''
+
+
 def free_path_parent_sibling_text(
     table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
     prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
     max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+    queue_min_gap=None,
 ):
     '''
     Text defining a database function which returns the next free path with retries.
 
     Arguments:
         table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
         prefix: prefix to add to all names (table, function, etc.)
         postfix: postfix to add to all names (table, function, etc.)
         max_digits: maximum number of digits in the number associated with each
             node at each path level.
         step_digits: number of digits to use as the step when inserting children
             at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
+        queue_min_gap: if not None, queue the parent for run_rebalancer() when
+            allocating from a gap with fewer free ordinals than this.
     '''
-    table_name = wrap_name(table_name, prefix=prefix, postfix=postfix)
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
     func_name = wrap_name('free_path_parent_sibling', prefix=prefix, postfix=postfix)
-    rebalance_name = wrap_name('rebalance', prefix=prefix, postfix=postfix)
+    rebalance_name = wrap_name('rebalance_gap', prefix=prefix, postfix=postfix)
     free_path_name = wrap_name('noretry_free_path_parent_sibling', prefix=prefix, postfix=postfix)
-    format_text = 'FM' + '0' * max_digits
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
+    queue_text = queue_parent_text(
+        'gap_after', prefix=prefix, postfix=postfix, queue_min_gap=queue_min_gap
+    )
     return text(f'''
 CREATE OR REPLACE FUNCTION public.{func_name}(parent ltree, after ltree DEFAULT NULL::ltree)
     RETURNS ltree
     LANGUAGE plpgsql
 AS $function$
-BEGIN
+DECLARE
+    gap_after ltree := CASE
+        WHEN after IS NULL OR after = '__LAST__' THEN parent || '__LAST__'::ltree
+        WHEN after = '__FIRST__' THEN parent || '__FIRST__'::ltree
+        ELSE after
+    END;
+    follow ltree[];
+BEGIN{queue_text}
 RETURN {free_path_name}(parent, after);
 EXCEPTION
     WHEN indicator_overflow THEN
         RAISE NOTICE 'rebalancing %', parent;
-        CALL {rebalance_name}(parent);
+        -- The rebalance moves "after" too: it sets gap_after to its new path.
+        CALL {rebalance_name}(gap_after, 1, follow);
+        IF nlevel(gap_after) = nlevel(parent) + 1 THEN
+            after := CASE subpath(gap_after, -1)
+                WHEN '__LAST__' THEN NULL
+                WHEN '__FIRST__' THEN '__FIRST__'::ltree
+                ELSE gap_after
+            END;
+        END IF;
         RETURN {free_path_name}(parent, after);
 END;
 $function$
@@ -394,65 +1147,884 @@ $function$
 
 def free_path_text(
     table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
     prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
     max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+    queue_min_gap=None,
 ):
     '''
     Text defining a database function which returns the next free path with retries.
 
     Arguments:
         table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
         prefix: prefix to add to all names (table, function, etc.)
         postfix: postfix to add to all names (table, function, etc.)
         max_digits: maximum number of digits in the number associated with each
             node at each path level.
         step_digits: number of digits to use as the step when inserting children
             at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
+        queue_min_gap: if not None, queue the parent for run_rebalancer() when
+            allocating from a gap with fewer free ordinals than this.
     '''
-    table_name = wrap_name(table_name, prefix=prefix, postfix=postfix)
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
     func_name = wrap_name('free_path', prefix=prefix, postfix=postfix)
-    rebalance_name = wrap_name('rebalance', prefix=prefix, postfix=postfix)
+    rebalance_name = wrap_name('rebalance_gap', prefix=prefix, postfix=postfix)
     free_path_name = wrap_name('noretry_free_path', prefix=prefix, postfix=postfix)
-    format_text = 'FM' + '0' * max_digits
+    label_name = wrap_name('label', prefix=prefix, postfix=postfix)
+    ordinal_name = wrap_name('ordinal', prefix=prefix, postfix=postfix)
+    max_pos, step_pos = ordinal_limits(max_digits, step_digits, encoding)
+    queue_text = queue_parent_text(
+        'after', prefix=prefix, postfix=postfix, queue_min_gap=queue_min_gap
+    )
     return text(f'''
 CREATE OR REPLACE FUNCTION public.{func_name}(after ltree)
     RETURNS ltree
     LANGUAGE plpgsql
 AS $function$
-BEGIN
+DECLARE
+    parent ltree := subpath(after, 0, -1);
+    follow ltree[];
+BEGIN{queue_text}
 RETURN {free_path_name}(after);
 EXCEPTION
     WHEN indicator_overflow THEN
-        RAISE NOTICE 'rebalancing %', subpath(after, 0, -1);
-        CALL {rebalance_name}(subpath(after, 0, -1));
+        RAISE NOTICE 'rebalancing %', parent;
+        -- The rebalance moves "after" too: it sets after to its new path.
+        CALL {rebalance_name}(after, 1, follow);
         RETURN {free_path_name}(after);
 END;
 $function$
 ''')
 
 
-def add_oltree_functions(
+def rebalance_queue_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+    queue_min_gap=1,
+):
+    '''
+    Text creating the rebalance queue table and the function which drains it.
+
+    free_path and free_path_parent_sibling queue short gaps when installed
+    with queue_min_gap. The rebalance_next function takes the oldest queued gap
+    nobody else is working on, widens it to queue_min_gap free ordinals with
+    the rebalance_gap procedure and returns its parent, or returns NULL if the
+    queue is empty. With rebalance='local' only a window of siblings around
+    the gap is renumbered. Call it once per transaction (see run_rebalancer())
+    so that sibling rows are only locked briefly.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        max_digits: maximum number of digits in the number associated with each
+            node at each path level.
+        step_digits: number of digits to use as the step when inserting children
+            at the beginning or end of the ordered set of children.
+        encoding: how ordinals are written as labels, a key of ENCODINGS.
+        queue_min_gap: number of free ordinals to make in a queued gap.
+    '''
+    queue_name = wrap_name('rebalance_queue', prefix=prefix, postfix=postfix)
+    func_name = wrap_name('rebalance_next', prefix=prefix, postfix=postfix)
+    rebalance_name = wrap_name('rebalance_gap', prefix=prefix, postfix=postfix)
+    gap_name = wrap_name('gap', prefix=prefix, postfix=postfix)
+    return text(f'''
+CREATE TABLE IF NOT EXISTS {queue_name} (
+    parent ltree PRIMARY KEY,
+    after ltree NOT NULL,
+    queued_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE OR REPLACE FUNCTION public.{func_name}()
+    RETURNS ltree
+    LANGUAGE plpgsql
+AS $function$
+DECLARE
+    queued ltree;
+    queued_after ltree;
+    follow ltree[];
+BEGIN
+DELETE FROM {queue_name} q
+WHERE q.parent = (
+    SELECT c.parent FROM {queue_name} c
+    ORDER BY c.queued_at
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING q.parent, q.after INTO queued, queued_after;
+IF queued IS NULL THEN
+    RETURN NULL;
+END IF;
+BEGIN
+    -- The gap may have been widened since it was queued.
+    IF (
+        SELECT g.hi - g.lo - 1 FROM {gap_name}(queued_after) AS g
+    ) < {int(queue_min_gap)} THEN
+        CALL {rebalance_name}(queued_after, {int(queue_min_gap)}, follow);
+    END IF;
+EXCEPTION
+    WHEN indicator_overflow THEN
+        -- Nothing more can be done ahead of time: allocations will raise.
+        RAISE WARNING 'out of space rebalancing %', queued;
+END;
+RETURN queued;
+END;
+$function$
+''')
+
+
+def run_rebalancer(
     engine,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    max_parents=None,
+):
+    '''
+    Rebalance queued gaps, each in its own transaction.
+
+    Runs until the queue is empty or max_parents gaps have been widened.
+    Several rebalancers can run at once. Returns the list of the parents of
+    the gaps handled.
+    '''
+    func_name = wrap_name('rebalance_next', prefix=prefix, postfix=postfix)
+    done = []
+    while max_parents is None or len(done) < max_parents:
+        with engine.begin() as con:
+            parent = con.execute(text(f'SELECT {func_name}()')).scalar()
+        if parent is None:
+            break
+        done.append(parent)
+    return done
+
+
+def name_path_insert_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    sep=DEFAULT_NAME_PATH_SEP,
+):
+    '''
+    Text defining a row trigger function which sets name_path on insert.
+
+    The name path is the stored name path of the parent plus node_name, so
+    parents must be inserted before their children.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        sep: separator between node names.
+    '''
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    func_name = wrap_name('name_path_insert', prefix=prefix, postfix=postfix)
+    sep = sep.replace("'", "''")
+    return text(f'''
+CREATE OR REPLACE FUNCTION public.{func_name}()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $function$
+BEGIN
+IF nlevel(NEW.path) > 1 THEN
+    NEW.name_path := (
+        SELECT name_path FROM {table_name}
+        WHERE path = subpath(NEW.path, 0, -1)
+    ) || '{sep}' || NEW.node_name;
+ELSE
+    NEW.name_path := NEW.node_name;
+END IF;
+RETURN NEW;
+END;
+$function$
+''')
+
+
+def name_path_update_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    sep=DEFAULT_NAME_PATH_SEP,
+):
+    '''
+    Text defining a statement trigger function which refreshes name_path.
+
+    Every subtree whose root changed path or node_name in the triggering
+    statement has its name paths rewritten by a single UPDATE. Only the roots
+    of the changed subtrees are collected (a move changes every row below
+    the moved node), and each root finds its subtree through the index on
+    path.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        sep: separator between node names.
+    '''
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    func_name = wrap_name('name_path_update', prefix=prefix, postfix=postfix)
+    sep = sep.replace("'", "''")
+    return text(f'''
+CREATE OR REPLACE FUNCTION public.{func_name}()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $function$
+DECLARE
+    changed ltree[];
+BEGIN
+-- Updates which only touch other columns (including the UPDATE below) leave
+-- nothing to do.
+changed := ARRAY(
+    WITH c AS (
+        SELECT path, node_name FROM new_rows
+        EXCEPT
+        SELECT path, node_name FROM old_rows
+    )
+    SELECT c.path FROM c
+    WHERE NOT EXISTS (
+        SELECT 1 FROM c AS p WHERE p.path = subpath(c.path, 0, -1)
+    )
+);
+IF cardinality(changed) = 0 THEN
+    RETURN NULL;
+END IF;
+UPDATE {table_name} AS t
+SET name_path = (
+    SELECT string_agg(a.node_name, '{sep}' ORDER BY nlevel(a.path))
+    FROM {table_name} AS a
+    WHERE a.path @> t.path
+)
+FROM unnest(changed) AS r(path)
+WHERE t.path <@ r.path;
+RETURN NULL;
+END;
+$function$
+''')
+
+
+def name_path_triggers_text(
     table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    sep=DEFAULT_NAME_PATH_SEP,
+):
+    '''
+    Text (re)creating the name_path triggers and filling in missing name paths.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        sep: separator between node names.
+    '''
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    insert_name = wrap_name('name_path_insert', prefix=prefix, postfix=postfix)
+    update_name = wrap_name('name_path_update', prefix=prefix, postfix=postfix)
+    sep = sep.replace("'", "''")
+    return text(f'''
+DROP TRIGGER IF EXISTS {insert_name} ON {table_name};
+CREATE TRIGGER {insert_name}
+    BEFORE INSERT ON {table_name}
+    FOR EACH ROW EXECUTE FUNCTION public.{insert_name}();
+DROP TRIGGER IF EXISTS {update_name} ON {table_name};
+CREATE TRIGGER {update_name}
+    AFTER UPDATE ON {table_name}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.{update_name}();
+UPDATE {table_name} AS t
+SET name_path = (
+    SELECT string_agg(a.node_name, '{sep}' ORDER BY nlevel(a.path))
+    FROM {table_name} AS a
+    WHERE a.path @> t.path
+)
+WHERE t.name_path IS NULL;
+''')
+
+
+def name_path_triggers_texts(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    sep=DEFAULT_NAME_PATH_SEP,
+):
+    '''
+    Texts installing the name_path triggers, in order.
+    '''
+    return [
+        globals()[f'{fname}_text'](
+            table_name=table_name,
+            full_table_name=full_table_name,
+            prefix=prefix,
+            postfix=postfix,
+            sep=sep
+        )
+        for fname in ('name_path_insert', 'name_path_update', 'name_path_triggers')
+    ]
+
+
+def name_path_triggers_present_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+):
+    '''
+    Text of a query which is true if the name_path triggers exist.
+
+    The triggers go when their table is dropped, which the installed record
+    can't know about.
+    '''
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    insert_name = wrap_name('name_path_insert', prefix=prefix, postfix=postfix)
+    update_name = wrap_name('name_path_update', prefix=prefix, postfix=postfix)
+    return text(f'''
+SELECT count(*) = 2 FROM pg_trigger
+WHERE tgrelid = to_regclass('{table_name}')
+AND tgname IN ('{insert_name}', '{update_name}')
+''')
+
+
+def change_log_name(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+):
+    '''
+    Name of the change log table of a table (see change_feed_text()).
+    '''
+    return wrap_name(
+        f'{full_table_name or table_name}_changes', prefix=prefix, postfix=postfix
+    )
+
+
+def change_feed_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    id_column='id', channel=None,
+):
+    '''
+    Text creating a change log of a table and the triggers which write it.
+
+    Each statement changing the table appends a batch of events to the log:
+
+    * insert: new_path, node_id, node_name of an inserted row.
+    * move: the subtree at old_path is now at new_path. Rows which moved along
+      with their parent (set_new_path(), rebalancing) are covered by the
+      parent's event, so moving a subtree is one event however big it is.
+    * rename: the node at new_path is now called node_name.
+    * delete: the subtree at old_path was deleted.
+    * delete_node: the node at old_path was deleted but some of its
+      descendants weren't.
+    * truncate: everything was deleted.
+
+    A notification with the last event id as payload is sent on channel
+    (default: the log table name) after each statement which logged anything.
+
+    Each event records the id of the transaction which wrote it. Ids are
+    handed out before commit, so a committed event can appear with a smaller
+    id than one already read. Readers should therefore remember the
+    transaction snapshot they last read at (txid_current_snapshot()) and next
+    read the events of transactions visible now but not then (see
+    SnapshotCache.changes()). Events of transactions still in progress are
+    skipped until they commit. Statements which change the same rows run one
+    after the other, so ordering by batch and id applies them in commit order.
+
+    Arguments:
+        table_name: name of the table which contains the nodes.
+        full_table_name: name of the table to use as is, instead of table_name
+            wrapped with prefix and postfix.
+        prefix: prefix to add to all names (table, function, etc.)
+        postfix: postfix to add to all names (table, function, etc.)
+        id_column: integer primary key column of the table, used to pair old
+            and new rows of updates.
+        channel: name of the channel to notify.
+    '''
+    log_name = change_log_name(
+        table_name=table_name, full_table_name=full_table_name,
+        prefix=prefix, postfix=postfix
+    )
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    batch_name = f'{log_name}_batch'
+    channel = (channel or log_name).replace("'", "''")
+    return text(f'''
+CREATE TABLE IF NOT EXISTS {log_name} (
+    id bigserial PRIMARY KEY,
+    batch bigint NOT NULL,
+    op text NOT NULL,
+    old_path ltree,
+    new_path ltree,
+    node_id bigint,
+    node_name text,
+    txid bigint NOT NULL DEFAULT txid_current(),
+    changed_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS {log_name}_txid ON {log_name} (txid);
+CREATE SEQUENCE IF NOT EXISTS {batch_name};
+CREATE OR REPLACE FUNCTION public.{log_name}_write()
+    RETURNS trigger
+    LANGUAGE plpgsql
+AS $function$
+DECLARE
+    batch_id bigint;
+    last_id bigint;
+BEGIN
+batch_id := nextval('{batch_name}');
+IF TG_OP = 'INSERT' THEN
+    INSERT INTO {log_name} (batch, op, new_path, node_id, node_name)
+    SELECT batch_id, 'insert', n.path, n.{id_column}, n.node_name
+    FROM new_rows n
+    ORDER BY n.path;
+ELSIF TG_OP = 'UPDATE' THEN
+    WITH moved AS (
+        SELECT o.path AS old_path, n.path AS new_path
+        FROM old_rows o JOIN new_rows n ON n.{id_column} = o.{id_column}
+        WHERE n.path <> o.path
+    )
+    INSERT INTO {log_name} (batch, op, old_path, new_path)
+    SELECT batch_id, 'move', m.old_path, m.new_path
+    FROM moved m
+    -- Skip rows which kept their place below a parent which moved.
+    WHERE NOT EXISTS (
+        SELECT 1 FROM moved p
+        WHERE nlevel(m.old_path) > 1
+        AND p.old_path = subpath(m.old_path, 0, nlevel(m.old_path) - 1)
+        AND p.new_path || subpath(m.old_path, -1) = m.new_path
+    )
+    ORDER BY m.old_path;
+    INSERT INTO {log_name} (batch, op, new_path, node_name)
+    SELECT batch_id, 'rename', n.path, n.node_name
+    FROM old_rows o JOIN new_rows n ON n.{id_column} = o.{id_column}
+    WHERE n.node_name IS DISTINCT FROM o.node_name
+    ORDER BY n.path;
+ELSIF TG_OP = 'DELETE' THEN
+    WITH roots AS (
+        SELECT d.path FROM old_rows d
+        WHERE NOT EXISTS (
+            SELECT 1 FROM old_rows p
+            WHERE nlevel(d.path) > 1
+            AND p.path = subpath(d.path, 0, nlevel(d.path) - 1)
+        )
+    ), gone AS (
+        SELECT r.path FROM roots r
+        WHERE NOT EXISTS (SELECT 1 FROM {table_name} t WHERE t.path <@ r.path)
+    )
+    INSERT INTO {log_name} (batch, op, old_path)
+    SELECT batch_id, 'delete', g.path FROM gone g
+    UNION ALL
+    SELECT batch_id, 'delete_node', d.path FROM old_rows d
+    WHERE NOT d.path <@ ARRAY(SELECT g.path FROM gone g);
+ELSE
+    INSERT INTO {log_name} (batch, op) VALUES (batch_id, 'truncate');
+END IF;
+SELECT max(id) INTO last_id FROM {log_name} WHERE batch = batch_id;
+IF last_id IS NOT NULL THEN
+    PERFORM pg_notify('{channel}', last_id::text);
+END IF;
+RETURN NULL;
+END;
+$function$;
+DROP TRIGGER IF EXISTS {log_name}_insert ON {table_name};
+CREATE TRIGGER {log_name}_insert
+    AFTER INSERT ON {table_name}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.{log_name}_write();
+DROP TRIGGER IF EXISTS {log_name}_update ON {table_name};
+CREATE TRIGGER {log_name}_update
+    AFTER UPDATE ON {table_name}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.{log_name}_write();
+DROP TRIGGER IF EXISTS {log_name}_delete ON {table_name};
+CREATE TRIGGER {log_name}_delete
+    AFTER DELETE ON {table_name}
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.{log_name}_write();
+DROP TRIGGER IF EXISTS {log_name}_truncate ON {table_name};
+CREATE TRIGGER {log_name}_truncate
+    AFTER TRUNCATE ON {table_name}
+    FOR EACH STATEMENT EXECUTE FUNCTION public.{log_name}_write();
+''')
+
+
+def change_feed_present_text(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+):
+    '''
+    Text of a query which is true if the change log and its triggers exist.
+    '''
+    log_name = change_log_name(
+        table_name=table_name, full_table_name=full_table_name,
+        prefix=prefix, postfix=postfix
+    )
+    table_name = full_table_name or wrap_name(
+        table_name, prefix=prefix, postfix=postfix
+    )
+    return text(f'''
+SELECT to_regclass('{log_name}') IS NOT NULL AND (
+    SELECT count(*) = 4 FROM pg_trigger
+    WHERE tgrelid = to_regclass('{table_name}')
+    AND tgname LIKE '{log_name}\\_%'
+)
+''')
+
+
+def install(engine, name, params, texts, present=(), force=False):
+    '''
+    Run texts in one transaction unless they are already installed.
+
+    What was installed under name is recorded in METADATA_TABLE along with
+    params and a digest of the texts. If the recorded digest matches (and all
+    the present queries are true), nothing is done, and that check takes no
+    locks. Otherwise the texts are run and the record updated in one
+    transaction holding an advisory lock, so processes starting together
+    install once. Use force to install regardless.
+
+    Returns True if the texts were run.
+    '''
+    version = hashlib.sha256(
+        '\n'.join(str(t) for t in texts).encode('utf-8')
+    ).hexdigest()
+    installed_query = text(f'''
+SELECT version FROM {METADATA_TABLE} WHERE name = :name
+''')
+
+    def installed(con):
+        return con.execute(
+            installed_query, {'name': name}
+        ).scalar() == version and all(
+            con.execute(query).scalar() for query in present
+        )
+
+    if not force:
+        with engine.connect() as con:
+            exists = con.execute(
+                text('SELECT to_regclass(:table) IS NOT NULL'),
+                {'table': METADATA_TABLE}
+            ).scalar()
+            if exists and installed(con):
+                return False
+    with engine.begin() as con:
+        con.execute(
+            text('SELECT pg_advisory_xact_lock(hashtext(:table))'),
+            {'table': METADATA_TABLE}
+        )
+        con.execute(text(f'''
+CREATE TABLE IF NOT EXISTS {METADATA_TABLE} (
+    name text PRIMARY KEY,
+    version text NOT NULL,
+    params jsonb NOT NULL,
+    installed_at timestamptz NOT NULL DEFAULT now()
+)
+'''))
+        # Another process may have installed while we waited for the lock.
+        if not force and installed(con):
+            return False
+        for t in texts:
+            con.execute(t)
+        con.execute(
+            text(f'''
+INSERT INTO {METADATA_TABLE} (name, version, params)
+VALUES (:name, :version, CAST(:params AS jsonb))
+ON CONFLICT (name) DO UPDATE SET
+    version = EXCLUDED.version,
+    params = EXCLUDED.params,
+    installed_at = now()
+'''),
+            {
+                'name': name,
+                'version': version,
+                'params': json.dumps(params, sort_keys=True),
+            }
+        )
+    return True
+
+
+def installed_params(engine, name):
+    '''
+    params recorded by install() for name, or None if nothing was installed.
+    '''
+    with engine.connect() as con:
+        exists = con.execute(
+            text('SELECT to_regclass(:table) IS NOT NULL'),
+            {'table': METADATA_TABLE}
+        ).scalar()
+        if not exists:
+            return None
+        return con.execute(
+            text(f'SELECT params FROM {METADATA_TABLE} WHERE name = :name'),
+            {'name': name}
+        ).scalar()
+
+
+def add_name_path_triggers(
+    engine,
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    sep=DEFAULT_NAME_PATH_SEP,
+    force=False,
+):
+    '''
+    Install the triggers which maintain the name_path column of NamePathMixin.
+
+    See install() for when anything is actually done. Returns True if the
+    triggers were (re)installed.
+    '''
+    return install(
+        engine,
+        wrap_name(
+            f'{full_table_name or table_name}_name_path_triggers',
+            prefix=prefix, postfix=postfix
+        ),
+        {
+            'table_name': table_name,
+            'full_table_name': full_table_name,
+            'prefix': prefix,
+            'postfix': postfix,
+            'sep': sep,
+        },
+        name_path_triggers_texts(
+            table_name=table_name, full_table_name=full_table_name,
+            prefix=prefix, postfix=postfix, sep=sep
+        ),
+        present=[name_path_triggers_present_text(
+            table_name=table_name, full_table_name=full_table_name,
+            prefix=prefix, postfix=postfix
+        )],
+        force=force,
+    )
+
+
+def add_change_feed(
+    engine,
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    id_column='id', channel=None,
+    force=False,
+):
+    '''
+    Install the change log of a table and its triggers (see change_feed_text()).
+
+    See install() for when anything is actually done. Returns True if the
+    change feed was (re)installed.
+    '''
+    return install(
+        engine,
+        change_log_name(
+            table_name=table_name, full_table_name=full_table_name,
+            prefix=prefix, postfix=postfix
+        ),
+        {
+            'table_name': table_name,
+            'full_table_name': full_table_name,
+            'prefix': prefix,
+            'postfix': postfix,
+            'id_column': id_column,
+            'channel': channel,
+        },
+        [change_feed_text(
+            table_name=table_name, full_table_name=full_table_name,
+            prefix=prefix, postfix=postfix,
+            id_column=id_column, channel=channel
+        )],
+        present=[change_feed_present_text(
+            table_name=table_name, full_table_name=full_table_name,
+            prefix=prefix, postfix=postfix
+        )],
+        force=force,
+    )
+
+
+def prune_change_log(
+    engine, up_to,
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+):
+    '''
+    Delete change log events with ids up to up_to, once every reader has them.
+
+    Returns the number of events deleted.
+    '''
+    log_name = change_log_name(
+        table_name=table_name, full_table_name=full_table_name,
+        prefix=prefix, postfix=postfix
+    )
+    with engine.begin() as con:
+        return con.execute(
+            text(f'DELETE FROM {log_name} WHERE id <= :up_to'), {'up_to': up_to}
+        ).rowcount
+
+
+def oltree_functions_texts(
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
     prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
     max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+    rebalance=DEFAULT_REBALANCE, queue_min_gap=None,
 ):
+    '''
+    Texts installing the functions used by OLtreeMixin, in order.
+    '''
     fnames = (
+        'labels',
         'rebalance',
+        'rebalance_gap',
         'noretry_free_path',
         'free_path',
         'noretry_free_path_parent_sibling',
         'free_path_parent_sibling',
+        'gap',
+        'free_paths',
+        'move_targets',
     )
+    if queue_min_gap is not None:
+        fnames += ('rebalance_queue',)
+    extra_args = {
+        'rebalance_gap': {'rebalance': rebalance},
+        'free_path': {'queue_min_gap': queue_min_gap},
+        'free_path_parent_sibling': {'queue_min_gap': queue_min_gap},
+        'rebalance_queue': {'queue_min_gap': queue_min_gap},
+    }
+    return [
+        globals()[f'{fname}_text'](
+            table_name=table_name,
+            full_table_name=full_table_name,
+            prefix=prefix,
+            postfix=postfix,
+            max_digits=max_digits,
+            step_digits=step_digits,
+            encoding=encoding,
+            **extra_args.get(fname, {})
+        )
+        for fname in fnames
+    ]
 
-    for fname in fnames:
-        with engine.begin() as con:
-            con.execute(
-                globals()[f'{fname}_text'](
-                    table_name=table_name,
-                    prefix=prefix,
-                    postfix=postfix,
-                    max_digits=max_digits,
-                    step_digits=step_digits
-                )
+
+def add_oltree_functions(
+    engine,
+    table_name=DEFAULT_TABLE_NAME,
+    full_table_name=None,
+    prefix=DEFAULT_PREFIX, postfix=DEFAULT_POSTFIX,
+    max_digits=DEFAULT_MAX_DIGITS, step_digits=DEFAULT_STEP_DIGITS,
+    encoding=DEFAULT_ENCODING,
+    name_path_triggers=False, name_path_sep=DEFAULT_NAME_PATH_SEP,
+    rebalance=DEFAULT_REBALANCE, queue_min_gap=None,
+    force=False,
+):
+    '''
+    Install the functions used by OLtreeMixin.
+
+    The functions are named with prefix and postfix and work on the table
+    full_table_name, or table_name wrapped with prefix and postfix. Use a
+    different prefix for each table which needs its own settings (see
+    OLtreeMixin.add_functions()).
+
+    Everything is installed in one transaction, and only if it differs from
+    what was last installed under the same prefix and postfix (see install()).
+    Returns True if anything was (re)installed. Raises ValueError if functions
+    with the same prefix and postfix were installed for a different table,
+    unless force is given to take them over.
+
+    rebalance chooses how room is made when a gap between siblings is full:
+    'local' renumbers a window around the gap, 'full' renumbers every child of
+    the parent.
+
+    If queue_min_gap is set, allocating a path from a gap with fewer free
+    ordinals than that queues the gap to be widened ahead of time by
+    run_rebalancer(), which makes room there as rebalance says. Allocations
+    which find a gap full still make room themselves.
+
+    encoding chooses how ordinals are written as labels (see ENCODINGS).
+    max_digits and step_digits count characters of that encoding: 9 'base62'
+    characters give more slots than 16 decimal ones.
+    '''
+    name = wrap_name('functions', prefix=prefix, postfix=postfix)
+    if not force:
+        installed = installed_params(engine, name)
+        if installed is not None:
+            table = full_table_name or wrap_name(
+                table_name, prefix=prefix, postfix=postfix
+            )
+            other = installed['full_table_name'] or wrap_name(
+                installed['table_name'], prefix=prefix, postfix=postfix
             )
+            if other != table:
+                raise ValueError(
+                    f'{name} are installed for {other}, not {table}: '
+                    'use a different prefix for each table.'
+                )
+    params = {
+        'table_name': table_name,
+        'full_table_name': full_table_name,
+        'prefix': prefix,
+        'postfix': postfix,
+        'max_digits': max_digits,
+        'step_digits': step_digits,
+        'encoding': encoding,
+        'name_path_triggers': name_path_triggers,
+        'name_path_sep': name_path_sep,
+        'rebalance': rebalance,
+        'queue_min_gap': queue_min_gap,
+    }
+    texts = oltree_functions_texts(
+        table_name=table_name,
+        full_table_name=full_table_name,
+        prefix=prefix,
+        postfix=postfix,
+        max_digits=max_digits,
+        step_digits=step_digits,
+        encoding=encoding,
+        rebalance=rebalance,
+        queue_min_gap=queue_min_gap,
+    )
+    present = []
+    if queue_min_gap is not None:
+        queue_name = wrap_name('rebalance_queue', prefix=prefix, postfix=postfix)
+        present.append(text(f"SELECT to_regclass('{queue_name}') IS NOT NULL"))
+    if name_path_triggers:
+        texts += name_path_triggers_texts(
+            table_name=table_name,
+            full_table_name=full_table_name,
+            prefix=prefix,
+            postfix=postfix,
+            sep=name_path_sep
+        )
+        present.append(name_path_triggers_present_text(
+            table_name=table_name, full_table_name=full_table_name,
+            prefix=prefix, postfix=postfix
+        ))
+    return install(
+        engine,
+        name,
+        params,
+        texts,
+        present=present,
+        force=force,
+    )
@@ -0,0 +1,172 @@
+'''
+Fractional index keys for ordered tree labels.
+
+A key is an integer part followed by a fraction. The first character of the
+integer part says how many digits follow it ('a' one, 'b' two, ... and 'Z',
+'Y', ... for negative integers), so appending or prepending only grows keys
+logarithmically. There is always room for another key between two keys:
+the fraction just gets longer. Keys only use characters valid in ltree labels
+and sort the same way as ltree compares labels.
+
+This follows the scheme of David Greenspan's fractional-indexing library.
+'''
+from .database import ENCODINGS
+
+__all__ = (
+    'key_between',
+    'n_keys_between',
+    'FRACTIONAL_DIGITS',
+)
+
+FRACTIONAL_DIGITS = ENCODINGS['base62']
+INTEGER_ZERO = 'a' + FRACTIONAL_DIGITS[0]
+SMALLEST_INTEGER = 'A' + FRACTIONAL_DIGITS[0] * 26
+
+
+def _integer_length(head):
+    if 'a' <= head <= 'z':
+        return ord(head) - ord('a') + 2
+    if 'A' <= head <= 'Z':
+        return ord('Z') - ord(head) + 2
+    raise ValueError(f'invalid key head {head!r}.')
+
+
+def _integer_part(key):
+    length = _integer_length(key[0])
+    if length > len(key):
+        raise ValueError(f'invalid key {key!r}.')
+    return key[:length]
+
+
+def _validate(key):
+    if key == SMALLEST_INTEGER:
+        raise ValueError(f'invalid key {key!r}.')
+    if not key or any(c not in FRACTIONAL_DIGITS for c in key):
+        raise ValueError(f'invalid key {key!r}.')
+    if key[len(_integer_part(key)):].endswith(FRACTIONAL_DIGITS[0]):
+        raise ValueError(f'invalid key {key!r}.')
+
+
+def _increment_integer(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        d = FRACTIONAL_DIGITS.index(digits[i]) + 1
+        if d < len(FRACTIONAL_DIGITS):
+            digits[i] = FRACTIONAL_DIGITS[d]
+            return head + ''.join(digits)
+        digits[i] = FRACTIONAL_DIGITS[0]
+    if head == 'Z':
+        return INTEGER_ZERO
+    if head == 'z':
+        return None
+    head = chr(ord(head) + 1)
+    if head > 'a':
+        digits.append(FRACTIONAL_DIGITS[0])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+
+def _decrement_integer(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        d = FRACTIONAL_DIGITS.index(digits[i]) - 1
+        if d >= 0:
+            digits[i] = FRACTIONAL_DIGITS[d]
+            return head + ''.join(digits)
+        digits[i] = FRACTIONAL_DIGITS[-1]
+    if head == 'a':
+        return 'Z' + FRACTIONAL_DIGITS[-1]
+    if head == 'A':
+        return None
+    head = chr(ord(head) - 1)
+    if head < 'Z':
+        digits.append(FRACTIONAL_DIGITS[-1])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+
+def _midpoint(a, b):
+    '''
+    Fraction strictly between fractions a and b (b may be None for no bound).
+    '''
+    zero = FRACTIONAL_DIGITS[0]
+    if b is not None:
+        n = 0
+        while (a[n] if n < len(a) else zero) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    digit_a = FRACTIONAL_DIGITS.index(a[0]) if a else 0
+    digit_b = FRACTIONAL_DIGITS.index(b[0]) if b is not None else len(FRACTIONAL_DIGITS)
+    if digit_b - digit_a > 1:
+        return FRACTIONAL_DIGITS[(digit_a + digit_b + 1) // 2]
+    if b is not None and len(b) > 1:
+        return b[:1]
+    return FRACTIONAL_DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def key_between(a, b):
+    '''
+    A key which sorts after a and before b.
+
+    Either may be None, meaning no bound on that side. Appending (b is None)
+    and prepending (a is None) give short keys.
+    '''
+    if a is not None:
+        _validate(a)
+    if b is not None:
+        _validate(b)
+    if a is not None and b is not None and a >= b:
+        raise ValueError(f'{a!r} is not before {b!r}.')
+    if a is None:
+        if b is None:
+            return INTEGER_ZERO
+        integer_b = _integer_part(b)
+        if integer_b == SMALLEST_INTEGER:
+            return integer_b + _midpoint('', b[len(integer_b):])
+        if integer_b < b:
+            return integer_b
+        key = _decrement_integer(integer_b)
+        if key is None:
+            raise ValueError('cannot make a key before the smallest key.')
+        return key
+    integer_a = _integer_part(a)
+    fraction_a = a[len(integer_a):]
+    if b is None:
+        key = _increment_integer(integer_a)
+        return integer_a + _midpoint(fraction_a, None) if key is None else key
+    integer_b = _integer_part(b)
+    if integer_a == integer_b:
+        return integer_a + _midpoint(fraction_a, b[len(integer_b):])
+    key = _increment_integer(integer_a)
+    if key < b:
+        return key
+    return integer_a + _midpoint(fraction_a, None)
+
+
+def n_keys_between(a, b, n):
+    '''
+    n keys in order, all after a and before b (either may be None).
+    '''
+    if n <= 0:
+        return []
+    if n == 1:
+        return [key_between(a, b)]
+    if b is None:
+        keys = [key_between(a, None)]
+        for _ in range(n - 1):
+            keys.append(key_between(keys[-1], None))
+        return keys
+    if a is None:
+        keys = [key_between(None, b)]
+        for _ in range(n - 1):
+            keys.append(key_between(None, keys[-1]))
+        return keys[::-1]
+    middle = n // 2
+    key = key_between(a, b)
+    return (
+        n_keys_between(a, key, middle) + [key] +
+        n_keys_between(key, b, n - middle - 1)
+    )
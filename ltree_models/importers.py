@@ -0,0 +1,402 @@
+'''
+Streaming importers for trees which come from outside the database.
+
+Imports are generator pipelines:
+
+* a source generator (iter_nested, iter_json, iter_csv) reads the input lazily
+  and yields one record per node, parents before children;
+* an importer assigns each record a path;
+* the resulting rows are written in batches of at most batch_size rows.
+
+Nested sources (python structures and JSON) only keep the currently open
+branch in memory. Parent/child CSV sources also keep an index from each source
+key to its assigned path, since a child may refer to any earlier row: memory
+grows with the number of rows, unless the rows are known to be in depth first
+order (depth_first=True), when only the open branch is kept.
+'''
+import csv
+import ltree_models
+
+from sqlalchemy import (
+    cast,
+    func,
+    insert,
+    literal,
+    literal_column,
+    Numeric,
+    select,
+)
+from sqlalchemy_utils import (
+    Ltree,
+    LtreeType,
+)
+from .models import parent_path_of
+from .populate import (
+    batched,
+    DEFAULT_BATCH_SIZE,
+)
+
+__all__ = (
+    'LtreeImporter',
+    'OLtreeImporter',
+    'iter_nested',
+    'iter_json',
+    'iter_csv',
+)
+
+
+def iter_nested(tree, name_key='name', children_key='children'):
+    '''
+    Walk nested dicts depth first, yielding (depth, node_name) tuples.
+
+    Arguments:
+        tree: a dict representing a node or an iterable of such dicts. Each
+            dict has a name under name_key and, optionally, an iterable of
+            child dicts under children_key. Children may be generators.
+        name_key: key holding the name of a node.
+        children_key: key holding the children of a node.
+    '''
+    if isinstance(tree, dict):
+        tree = (tree,)
+    stack = [iter(tree)]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            continue
+        yield len(stack) - 1, str(node[name_key])
+        stack.append(iter(node.get(children_key) or ()))
+
+
+def _join_prefix(prefix, key):
+    return f'{prefix}.{key}' if prefix else key
+
+
+def iter_json(fp, name_key='name', children_key='children'):
+    '''
+    Stream nested JSON from a file object, yielding (depth, node_name) tuples.
+
+    The document is either one node object or an array of them, in the same
+    shape as accepted by iter_nested(). The name of each node must come before
+    its children in the document. Requires the optional ijson package.
+    '''
+    try:
+        import ijson  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        raise ImportError('iter_json() requires the ijson package.') from e
+    # Each open node is [prefix, node_name, emitted].
+    stack = []
+    for prefix, event, value in ijson.parse(fp):
+        if stack:
+            top = stack[-1]
+            child_prefix = _join_prefix(
+                _join_prefix(top[0], children_key), 'item'
+            )
+        else:
+            top = None
+            child_prefix = None
+        if event == 'start_map' and (
+            prefix == child_prefix or (top is None and prefix in ('', 'item'))
+        ):
+            stack.append([prefix, None, False])
+        elif top is None:
+            continue
+        elif prefix == _join_prefix(top[0], name_key) and event in (
+            'string', 'number', 'boolean'
+        ):
+            top[1] = str(value)
+        elif event == 'start_array' and prefix == _join_prefix(top[0], children_key):
+            if top[1] is None:
+                raise ValueError(
+                    f'node at "{top[0]}" has children before a "{name_key}".'
+                )
+            top[2] = True
+            yield len(stack) - 1, top[1]
+        elif event == 'end_map' and prefix == top[0]:
+            if not top[2]:
+                if top[1] is None:
+                    raise ValueError(f'node at "{top[0]}" has no "{name_key}".')
+                yield len(stack) - 1, top[1]
+            stack.pop()
+
+
+def iter_csv(
+    fp,
+    id_column='id', parent_column='parent_id', name_column='name',
+    **reader_args
+):
+    '''
+    Stream parent/child rows from a CSV file object.
+
+    Yields (parent_key, key, node_name) tuples. Rows with an empty parent
+    column are top level nodes. Every parent must appear before its children.
+    Extra keyword arguments are passed to csv.DictReader.
+    '''
+    for row in csv.DictReader(fp, **reader_args):
+        yield row[parent_column] or None, row[id_column], row[name_column]
+
+
+class LtreeImporter:
+    '''
+    Import external trees into a table using LtreeMixin.
+
+    Children are labelled sequentially in source order, after any numbered
+    children already under the parent.
+    '''
+
+    def __init__(
+        self,
+        engine, node_class,
+    ):
+        self.engine = engine
+        self.Node = node_class
+
+    def label(self, i):
+        '''
+        Label of the i'th child of a parent.
+        '''
+        return Ltree(str(i))
+
+    def child_path(self, parent_path, i):
+        if parent_path is None:
+            return self.label(i)
+        return parent_path + self.label(i)
+
+    def children_query(self, query, parent_path):
+        '''
+        query restricted to the children of parent_path (None: top level).
+        '''
+        Node = self.Node
+        if parent_path is None:
+            query = query.where(func.nlevel(Node.path) == 1)
+        else:
+            query = query.where(
+                parent_path_of(Node.path) ==
+                literal(Ltree(str(parent_path)), LtreeType)
+            )
+        return query
+
+    @property
+    def last_label(self):
+        '''
+        SQL expression for the last label of a node's path.
+        '''
+        return func.ltree2text(func.subpath(self.Node.path, literal_column('-1')))
+
+    def first_index(self, parent_path=None):
+        '''
+        Index of the first imported child of parent_path (None: top level), so
+        that imported labels come after those already in the table.
+        '''
+        label = self.last_label
+        query = self.children_query(
+            select(func.max(cast(label, Numeric))), parent_path
+        ).where(label.regexp_match('^[0-9]+$'))
+        with self.engine.connect() as con:
+            last = con.execute(query).scalar()
+        return 0 if last is None else int(last) + 1
+
+    def paths_from_depths(self, records, parent_path=None, first_index=0):
+        '''
+        Assign paths to (depth, node_name) records in depth first order.
+
+        Top level records are numbered from first_index. Yields dicts ready to
+        insert. Memory is proportional to tree depth.
+        '''
+        parent_path = Ltree(parent_path) if parent_path is not None else None
+        # Each entry is [path, number of children seen so far].
+        stack = [[parent_path, first_index]]
+        for depth, node_name in records:
+            if depth >= len(stack):
+                raise ValueError(f'{node_name!r} at depth {depth} has no parent.')
+            del stack[depth + 1:]
+            parent = stack[depth]
+            path = self.child_path(parent[0], parent[1])
+            parent[1] += 1
+            stack.append([path, 0])
+            yield {'node_name': node_name, 'path': path}
+
+    def paths_from_parents(
+        self, records, parent_path=None, first_index=0, depth_first=False
+    ):
+        '''
+        Assign paths to (parent_key, key, node_name) records.
+
+        Top level records are numbered from first_index. Yields dicts ready to
+        insert.
+
+        Any earlier record may be a parent, so an index from key to path is
+        kept for every node seen so far and memory grows with the number of
+        records. If the records are in depth first order (each node's subtree
+        before its next sibling) pass depth_first: only the open branch is
+        kept, memory is proportional to tree depth, and a record whose parent
+        isn't on the open branch raises ValueError.
+        '''
+        parent_path = Ltree(parent_path) if parent_path is not None else None
+        top = [parent_path, first_index]
+        index = {}
+        # Keys of the open branch, top first (depth_first only).
+        branch = []
+        for parent_key, key, node_name in records:
+            if parent_key is None:
+                parent = top
+                if depth_first:
+                    index.clear()
+                    branch.clear()
+            else:
+                if depth_first:
+                    while branch and branch[-1] != parent_key:
+                        del index[branch.pop()]
+                try:
+                    parent = index[parent_key]
+                except KeyError:
+                    if depth_first:
+                        raise ValueError(
+                            f'parent {parent_key!r} of {key!r} is not on the '
+                            'open branch: records are not in depth first order.'
+                        ) from None
+                    raise ValueError(
+                        f'parent {parent_key!r} of {key!r} has not been seen.'
+                    ) from None
+            path = self.child_path(parent[0], parent[1])
+            parent[1] += 1
+            index[key] = [path, 0]
+            if depth_first:
+                branch.append(key)
+            yield {'node_name': node_name, 'path': path}
+
+    def write(self, rows, batch_size=DEFAULT_BATCH_SIZE):
+        '''
+        Insert rows in batches of at most batch_size within one transaction.
+
+        Returns the number of rows written.
+        '''
+        table = self.Node.__table__
+        count = 0
+        with self.engine.begin() as con:
+            for batch in batched(rows, batch_size):
+                con.execute(insert(table), batch)
+                count += len(batch)
+        return count
+
+    def import_nested(
+        self, tree, parent_path=None,
+        name_key='name', children_key='children',
+        batch_size=DEFAULT_BATCH_SIZE,
+    ):
+        '''
+        Import nested dicts (see iter_nested()), optionally under parent_path.
+        '''
+        return self.write(
+            self.paths_from_depths(
+                iter_nested(tree, name_key=name_key, children_key=children_key),
+                parent_path=parent_path,
+                first_index=self.first_index(parent_path),
+            ),
+            batch_size=batch_size,
+        )
+
+    def import_json(
+        self, fp, parent_path=None,
+        name_key='name', children_key='children',
+        batch_size=DEFAULT_BATCH_SIZE,
+    ):
+        '''
+        Stream nested JSON (see iter_json()), optionally under parent_path.
+        '''
+        return self.write(
+            self.paths_from_depths(
+                iter_json(fp, name_key=name_key, children_key=children_key),
+                parent_path=parent_path,
+                first_index=self.first_index(parent_path),
+            ),
+            batch_size=batch_size,
+        )
+
+    def import_csv(
+        self, fp, parent_path=None,
+        id_column='id', parent_column='parent_id', name_column='name',
+        batch_size=DEFAULT_BATCH_SIZE, depth_first=False,
+        **reader_args
+    ):
+        '''
+        Stream parent/child CSV (see iter_csv()), optionally under parent_path.
+
+        Pass depth_first for large files in depth first order, so that memory
+        doesn't grow with the number of rows (see paths_from_parents()).
+        '''
+        return self.write(
+            self.paths_from_parents(
+                iter_csv(
+                    fp, id_column=id_column, parent_column=parent_column,
+                    name_column=name_column, **reader_args
+                ),
+                parent_path=parent_path,
+                first_index=self.first_index(parent_path),
+                depth_first=depth_first,
+            ),
+            batch_size=batch_size,
+        )
+
+
+class OLtreeImporter(LtreeImporter):
+    '''
+    Import external trees into a table using OLtreeMixin.
+
+    The number of children of a node isn't known until the stream has passed
+    them, so children get ordinals step_number apart in source order, the same
+    spacing the free_path function uses when appending. Children imported
+    under an existing parent start after its last child. The digits and
+    encoding default to the settings of the node class.
+    '''
+
+    def __init__(
+        self,
+        engine, node_class,
+        max_digits=None,
+        step_digits=None,
+        encoding=None,
+    ):
+        super().__init__(engine, node_class)
+        if max_digits is None:
+            max_digits = node_class.max_digits
+        if step_digits is None:
+            step_digits = node_class.step_digits
+        if encoding is None:
+            encoding = node_class.encoding
+        self.max_digits = max_digits
+        self.step_digits = step_digits
+        self.encoding = encoding
+        self.max_number, self.step_number = ltree_models.ordinal_limits(
+            max_digits, step_digits, encoding
+        )
+
+    def label(self, i):
+        ordinal = self.step_number * (i + 1)
+        if ordinal > self.max_number:
+            raise ValueError(
+                f'more than {i} children: out of space with max_digits='
+                f'{self.max_digits}, step_digits={self.step_digits}.'
+            )
+        return Ltree(ltree_models.encode_ordinal(
+            ordinal, self.max_digits, self.encoding
+        ))
+
+    def first_index(self, parent_path=None):
+        '''
+        Index of the first imported child of parent_path (None: top level):
+        the first whose ordinal is after that of the last child in the table.
+
+        Only labels written with this importer's encoding and max_digits count
+        as ordinals, so top level names like 'r' are ignored.
+        '''
+        alphabet = ltree_models.ENCODINGS[self.encoding]
+        label = self.last_label
+        query = self.children_query(select(label), parent_path).where(
+            label.regexp_match(f'^[{alphabet}]{{{self.max_digits}}}$')
+        ).order_by(self.Node.path.desc()).limit(1)
+        with self.engine.connect() as con:
+            last = con.execute(query).scalar_one_or_none()
+        if last is None:
+            return 0
+        return ltree_models.decode_ordinal(last, self.encoding) // self.step_number
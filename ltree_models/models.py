@@ -12,21 +12,37 @@ siblings in the tree.
 
 OLtreeMixin will produce an ordered and re-orderable tree: the path of each node
 is a dotted set of numbers where the numbers represent sibling order.
+
+FLtreeMixin is an ordered tree whose labels are fractional index keys: there is
+always room between two siblings, so it never needs rebalancing.
+
+Methods which query the database have async counterparts, prefixed with "a",
+for nodes loaded through sqlalchemy.ext.asyncio.AsyncSession. They run the
+same code on the event loop the way AsyncSession itself does, so there is one
+implementation of each operation.
 '''
 import sqlalchemy
 
 from sqlalchemy_utils import LtreeType, Ltree
+from sqlalchemy_utils.types.ltree import LQUERY
 from sqlalchemy import (
     and_,
+    any_,
     BigInteger,
     bindparam,
     case,
+    cast,
     column,
     Column,
+    FetchedValue,
     Text,
     Index,
+    Integer,
     UniqueConstraint,
     func,
+    inspect,
+    literal,
+    literal_column,
     select,
     Sequence,
     text,
@@ -44,21 +60,90 @@ from sqlalchemy.orm import (
     remote,
     Session,
 )
+from sqlalchemy.orm.attributes import (
+    instance_state,
+    set_committed_value,
+)
+from sqlalchemy.dialects.postgresql import (
+    aggregate_order_by,
+    ARRAY,
+)
+from sqlalchemy.ext.asyncio import (
+    async_object_session,
+)
 from sqlalchemy.ext.hybrid import (
     hybrid_property,
 )
+from .database import (
+    add_oltree_functions,
+    wrap_name,
+    DEFAULT_ENCODING,
+    DEFAULT_MAX_DIGITS,
+    DEFAULT_POSTFIX,
+    DEFAULT_PREFIX,
+    DEFAULT_STEP_DIGITS,
+)
+from .fractional import (
+    key_between,
+    n_keys_between,
+)
 
 __all__ = (
     'LtreeMixin',
     'OLtreeMixin',
+    'FLtreeMixin',
+    'NamePathMixin',
+    'DEFAULT_MAX_LABEL_LENGTH',
+    'DEFAULT_YIELD_PER',
 )
 
+DEFAULT_MAX_LABEL_LENGTH = 8
+DEFAULT_YIELD_PER = 1000
+
 
 def subpath(path, offset, length=None):
     path = str(path)
     return Ltree('.'.join(path.split('.')[offset:length]))
 
 
+def parent_path_of(path):
+    '''
+    SQL expression for the path of the parent of path.
+
+    The offsets are rendered inline so that the expression always matches the
+    parent path index, however the driver binds parameters.
+    '''
+    return func.subpath(path, literal_column('0'), literal_column('-1'))
+
+
+def nest_rows(rows, keys, children_key='children'):
+    '''
+    Nest (path, *values) rows in path order, returning the top level dicts.
+
+    Each node becomes a dict of keys to values (Ltree values as strings) with
+    its children, in order, under children_key. One pass with a stack of the
+    current ancestors. A node whose parent isn't in rows goes under its
+    nearest ancestor which is.
+    '''
+    top = []
+    stack = []
+    for path, *values in rows:
+        labels = str(path).split('.')
+        while stack and not (
+            len(stack[-1][0]) < len(labels) and
+            labels[:len(stack[-1][0])] == stack[-1][0]
+        ):
+            stack.pop()
+        node = {
+            key: str(value) if isinstance(value, Ltree) else value
+            for key, value in zip(keys, values)
+        }
+        node[children_key] = []
+        (stack[-1][1] if stack else top).append(node)
+        stack.append((labels, node[children_key]))
+    return top
+
+
 @declarative_mixin
 class Common:
     '''
@@ -67,6 +152,23 @@ class Common:
 
     name_path_sep = '/'
 
+    # Index policy. Override these on the model class before the table is
+    # created.
+    #
+    # gist_index: GiST index on path for @>, <@, ~ and @ queries.
+    # gist_siglen: signature length in bytes for the GiST index (postgresql
+    #     13+), or None for the default.
+    # parent_path_index: btree index on the parent path expression used by
+    #     the parent/children relationships.
+    # nlevel_index: btree index on nlevel(path) for level queries.
+    # prefix_index: btree index on the text of path with text_pattern_ops,
+    #     used by path_text_startswith().
+    gist_index = True
+    gist_siglen = None
+    parent_path_index = True
+    nlevel_index = True
+    prefix_index = False
+
     # TODO
     # Not sure how to make a sequence exist in the DB before other columns are
     # created without attaching it to its own column.
@@ -74,6 +176,59 @@ class Common:
     # But I'd really like to be able to do something like this:
     # path_id_seq = Sequence('path_id_seq')
 
+    @declared_attr
+    def __table_args__(cls):  # pylint: disable=no-self-argument
+        return cls.index_args() + (
+            UniqueConstraint('path', deferrable=True, initially='immediate'),
+        )
+
+    @classmethod
+    def index_args(cls):
+        '''
+        Indexes on path according to the index policy.
+        '''
+        table_name = cls.__tablename__  # pylint: disable=no-member
+        indexes = []
+        if cls.gist_index:
+            ops = {}
+            if cls.gist_siglen:
+                ops = {'path': f'gist_ltree_ops(siglen={int(cls.gist_siglen)})'}
+            indexes.append(Index(
+                f'{table_name}_path_idx', cls.path,
+                postgresql_using='gist', postgresql_ops=ops
+            ))
+        if cls.parent_path_index:
+            indexes.append(Index(
+                f'{table_name}_parent_path_idx', parent_path_of(cls.path)
+            ))
+        if cls.nlevel_index:
+            indexes.append(Index(
+                f'{table_name}_nlevel_idx', func.nlevel(cls.path)
+            ))
+        if cls.prefix_index:
+            indexes.append(Index(
+                f'{table_name}_path_text_idx',
+                func.ltree2text(cls.path).label('path_text'),
+                postgresql_ops={'path_text': 'text_pattern_ops'}
+            ))
+        return tuple(indexes)
+
+    @classmethod
+    def path_text_startswith(cls, prefix):
+        '''
+        Clause matching paths whose text starts with prefix.
+
+        Unlike <@ this matches partial labels ('r.12' matches 'r.123'). Served
+        by the prefix index: the pattern is rendered into the statement when
+        it runs, as the planner can only use the index for a known prefix.
+        '''
+        escaped = str(prefix).replace(
+            '\\', '\\\\'
+        ).replace('%', '\\%').replace('_', '\\_')
+        return func.ltree2text(cls.path).like(bindparam(
+            None, escaped + '%', type_=Text, literal_execute=True
+        ))
+
     @staticmethod
     def next_path_id(session):
         '''
@@ -110,7 +265,7 @@ class Common:
 
     @parent_path.expression
     def parent_path(cls):  # pylint: disable=no-self-argument
-        return func.subpath(cls.path, 0, -1)
+        return parent_path_of(cls.path)
 
     @declared_attr
     def node_name(cls):  # pylint: disable=no-self-argument
@@ -125,11 +280,51 @@ class Common:
         name_list.append(self.node_name)
         return self.name_path_sep.join(name_list)
 
+    @name_path.expression
+    def name_path(cls):  # pylint: disable=no-self-argument
+        ancestor = aliased(cls)
+        return select(
+            func.string_agg(
+                ancestor.node_name,
+                aggregate_order_by(
+                    literal(cls.name_path_sep), func.nlevel(ancestor.path)
+                )
+            )
+        ).where(
+            ancestor.path.op('@>', is_comparison=True)(cls.path)
+        ).scalar_subquery()
+
+    @classmethod
+    def with_name_paths(cls, session, path=None):
+        '''
+        Fetch (node, name_path) for every node in the subtree at path in one query.
+
+        All nodes are returned if path is None.
+        '''
+        query = select(cls, cls.name_path).order_by(cls.path)
+        if path is not None:
+            query = query.where(
+                cls.path.op('<@', is_comparison=True)(Ltree(str(path)))
+            )
+        return session.execute(query).all()
+
+    @classmethod
+    def get_by_name_path(cls, session, name_path):
+        '''
+        Get the node with name_path, or None.
+
+        Raises sqlalchemy.exc.MultipleResultsFound if the name path is
+        ambiguous. Only an index lookup when NamePathMixin is used.
+        '''
+        return session.execute(
+            select(cls).where(cls.name_path == name_path)
+        ).scalar_one_or_none()
+
     @declared_attr
     def parent(cls):  # pylint: disable=no-self-argument
         return relationship(
             cls,
-            primaryjoin=lambda: remote(cls.path) == func.subpath(foreign(cls.path), 0, -1),
+            primaryjoin=lambda: remote(cls.path) == parent_path_of(foreign(cls.path)),
             backref='children',
             viewonly=True,
         )
@@ -147,56 +342,402 @@ class Common:
             viewonly=True
         )
 
+    @classmethod
+    def load_ancestors(cls, session, nodes):
+        '''
+        Load ancestors and parent of many nodes in one query.
+
+        The paths of all the ancestors are worked out from the nodes' paths
+        and fetched with one path = ANY(...) lookup on the unique path index.
+        ancestors and parent are then set on the nodes, and on the ancestors
+        fetched, so that reading them doesn't query. Returns nodes.
+        '''
+        nodes = list(nodes)
+        loaded = {str(node.path): node for node in nodes}
+        prefixes = set()
+        for path in loaded:
+            labels = path.split('.')
+            prefixes.update('.'.join(labels[:n]) for n in range(1, len(labels)))
+        missing = sorted(prefixes.difference(loaded))
+        if missing:
+            loaded.update(
+                (str(node.path), node) for node in session.execute(
+                    select(cls).where(
+                        cls.path == any_(cast(
+                            bindparam('prefixes', missing, type_=ARRAY(Text)),
+                            ARRAY(LtreeType)
+                        ))
+                    )
+                ).scalars()
+            )
+        for path, node in loaded.items():
+            labels = path.split('.')
+            ancestors = [
+                loaded[prefix] for prefix in (
+                    '.'.join(labels[:n]) for n in range(1, len(labels))
+                ) if prefix in loaded
+            ]
+            set_committed_value(node, 'ancestors', ancestors)
+            set_committed_value(
+                node, 'parent', loaded.get('.'.join(labels[:-1]))
+            )
+        return nodes
+
+    @classmethod
+    async def aload_ancestors(cls, session, nodes):
+        '''
+        Async load_ancestors() with an AsyncSession.
+        '''
+        return await session.run_sync(cls.load_ancestors, list(nodes))
+
+    @classmethod
+    def descendants_of(cls, path, max_depth=None, min_depth=1):
+        '''
+        Clause matching nodes min_depth to max_depth levels below path.
+
+        Uses an lquery (path.*{min,max}) which the GiST index answers directly.
+        max_depth=None means no lower limit on the tree.
+        '''
+        upper = '' if max_depth is None else int(max_depth)
+        lquery = f'{path}.*{{{int(min_depth)},{upper}}}'
+        return cls.path.op('~', is_comparison=True)(cast(literal(lquery), LQUERY))
+
+    @classmethod
+    def subtree_query(cls, path=None, max_depth=None, columns=None):
+        '''
+        Query for the subtree at path (the whole table if None) in path order.
+
+        columns is a sequence of attribute names or column expressions to
+        select instead of nodes.
+        '''
+        if columns:
+            query = select(*(
+                getattr(cls, c) if isinstance(c, str) else c for c in columns
+            ))
+        else:
+            query = select(cls)
+        if path is not None:
+            query = query.where(
+                cls.descendants_of(path, max_depth=max_depth, min_depth=0)
+            )
+        return query.order_by(cls.path)
+
+    @classmethod
+    def iter_subtree(
+        cls, session, path=None, max_depth=None, columns=None,
+        batch_size=DEFAULT_YIELD_PER
+    ):
+        '''
+        Iterate over the subtree at path in path order without loading it all.
+
+        Rows come from a server side cursor batch_size at a time, so memory
+        stays constant as long as the caller doesn't keep the nodes. Yields
+        nodes, or rows of columns (see subtree_query()). The session's
+        transaction stays open until the iteration finishes.
+        '''
+        result = session.execute(
+            cls.subtree_query(
+                path=path, max_depth=max_depth, columns=columns
+            ).execution_options(yield_per=batch_size)
+        )
+        yield from result if columns else result.scalars()
+
+    @classmethod
+    async def aiter_subtree(
+        cls, session, path=None, max_depth=None, columns=None,
+        batch_size=DEFAULT_YIELD_PER
+    ):
+        '''
+        Async iter_subtree() with an AsyncSession.
+        '''
+        result = await session.stream(
+            cls.subtree_query(
+                path=path, max_depth=max_depth, columns=columns
+            ).execution_options(yield_per=batch_size)
+        )
+        if not columns:
+            result = result.scalars()
+        async for row in result:
+            yield row
+
+    def descendants(self, max_depth=None):
+        '''
+        Descendants of this node down to max_depth levels below it, in path order.
+        '''
+        cls = self.__class__
+        s = object_session(self)
+        return s.execute(
+            select(cls).where(
+                cls.descendants_of(self.path, max_depth=max_depth)
+            ).order_by(cls.path)
+        ).scalars().all()
+
+    def subtree_as_nested(
+        self, max_depth=None, columns=('id', 'node_name'),
+        children_key='children'
+    ):
+        '''
+        The subtree rooted here as nested dicts, from one path ordered query.
+
+        columns are the attribute names to include for each node, and
+        max_depth limits how many levels below this node are included. The
+        result is ready for json.dumps() (see nest_rows()).
+        '''
+        columns = list(columns)
+        rows = self.iter_subtree(
+            object_session(self), path=self.path, max_depth=max_depth,
+            columns=['path'] + columns
+        )
+        return nest_rows(rows, columns, children_key=children_key)[0]
+
+    def descendants_at_level(self, depth):
+        '''
+        Descendants exactly depth levels below this node, in path order.
+        '''
+        cls = self.__class__
+        s = object_session(self)
+        return s.execute(
+            select(cls).where(
+                cls.descendants_of(self.path, max_depth=depth, min_depth=depth)
+            ).order_by(cls.path)
+        ).scalars().all()
+
+    def subtree_size(self, max_depth=None):
+        '''
+        Number of nodes in the subtree rooted here (including this node).
+        '''
+        cls = self.__class__
+        s = object_session(self)
+        return s.execute(
+            select(func.count()).where(
+                cls.descendants_of(self.path, max_depth=max_depth, min_depth=0)
+            )
+        ).scalar_one()
+
     def set_new_path(self, new_path):
         '''
         Change the path of this node and update all children.
+
+        The whole subtree is rewritten by one UPDATE. Nodes of the subtree
+        which are already in the session are given their new paths in python
+        rather than being fetched again.
         '''
         cls = self.__class__
         s = object_session(self)
+        old_path = self.path
+        new_path = Ltree(str(new_path))
         # with Session(object_session(self).get_bind(), future=True) as s:
         s.execute(
             update(
                 cls
             ).where(
-                cls.path.op('<@', is_comparison=True)(self.path)
+                cls.path.op('<@', is_comparison=True)(old_path)
             ).values(
                 path=case(
                     (
-                        cls.path == self.path,
+                        cls.path == old_path,
                         new_path
                     ),
                     (
-                        cls.path != self.path,
+                        cls.path != old_path,
                         # new_path + func.subpath(cls.path, func.nlevel(self.path))
                         text(":new_path || subpath(path, nlevel(:current_path))")
                     )
                 )
             ).execution_options(
-                synchronize_session='fetch'
+                synchronize_session=False
             ),
-            params={'new_path': new_path, 'current_path': self.path}
+            params={'new_path': new_path, 'current_path': old_path}
         )
+        self.sync_moved_subtrees(s, {old_path: new_path})
+
+    async def _arun(self, fn, *args, **kwargs):
+        '''
+        Call fn(*args, **kwargs) inside this node's AsyncSession.
+
+        fn may use object_session() and block on the database as usual: it runs
+        in the session's greenlet, not in a thread.
+        '''
+        s = async_object_session(self)
+        if s is None:
+            raise ValueError(f'{self!r} is not in an AsyncSession.')
+        return await s.run_sync(lambda session: fn(*args, **kwargs))
+
+    async def adescendants(self, max_depth=None):
+        '''
+        Async descendants().
+        '''
+        return await self._arun(self.descendants, max_depth=max_depth)
+
+    async def adescendants_at_level(self, depth):
+        '''
+        Async descendants_at_level().
+        '''
+        return await self._arun(self.descendants_at_level, depth)
+
+    async def asubtree_as_nested(
+        self, max_depth=None, columns=('id', 'node_name'),
+        children_key='children'
+    ):
+        '''
+        Async subtree_as_nested().
+        '''
+        return await self._arun(
+            self.subtree_as_nested, max_depth=max_depth, columns=columns,
+            children_key=children_key
+        )
+
+    async def asubtree_size(self, max_depth=None):
+        '''
+        Async subtree_size().
+        '''
+        return await self._arun(self.subtree_size, max_depth=max_depth)
+
+    async def aset_new_path(self, new_path):
+        '''
+        Async set_new_path().
+        '''
+        return await self._arun(self.set_new_path, new_path)
+
+    @classmethod
+    async def aapply_moves(cls, session, moves):
+        '''
+        Async apply_moves() with an AsyncSession.
+        '''
+        return await session.run_sync(cls.apply_moves, moves)
+
+    @classmethod
+    def sync_moved_subtrees(cls, session, moves):
+        '''
+        Bring nodes in session up to date after subtrees moved.
+
+        moves maps old subtree root paths to new ones. Matching is done on the
+        loaded paths in the identity map, so nothing is fetched from the
+        database. Columns the database may change on update (server_onupdate)
+        are expired.
+        '''
+        moves = {str(old): str(new) for old, new in moves.items()}
+        expire_keys = [
+            attr.key for attr in inspect(cls).column_attrs
+            if any(c.server_onupdate is not None for c in attr.columns)
+        ]
+        for obj in list(session.identity_map.values()):
+            if not isinstance(obj, cls):
+                continue
+            state = instance_state(obj)
+            if 'path' not in state.dict:
+                continue
+            labels = str(state.dict['path']).split('.')
+            for level in range(len(labels), 0, -1):
+                new = moves.get('.'.join(labels[:level]))
+                if new is not None:
+                    break
+            else:
+                continue
+            set_committed_value(
+                obj, 'path', Ltree('.'.join([new] + labels[level:]))
+            )
+            if expire_keys:
+                session.expire(obj, expire_keys)
+
+    @classmethod
+    def apply_moves(cls, session, moves):
+        '''
+        Move many subtrees in one UPDATE.
+
+        moves is a sequence of (source path, target path) pairs. No source may
+        be inside another source's subtree. Targets may swap with sources: the
+        deferrable unique constraint on path is only checked at the end of the
+        statement.
+        '''
+        moves = [(str(source), str(target)) for source, target in moves]
+        if not moves:
+            return
+        ordered = sorted(source for source, _ in moves)
+        for first, second in zip(ordered, ordered[1:]):
+            if second == first or second.startswith(first + '.'):
+                raise ValueError(f'{second} is inside moved subtree {first}.')
+        batch = func.unnest(
+            cast(
+                bindparam('sources', [m[0] for m in moves], type_=ARRAY(Text)),
+                ARRAY(LtreeType)
+            ),
+            cast(
+                bindparam('targets', [m[1] for m in moves], type_=ARRAY(Text)),
+                ARRAY(LtreeType)
+            ),
+        ).table_valued(
+            column('source', LtreeType), column('target', LtreeType)
+        ).render_derived()
+        session.execute(
+            update(
+                cls
+            ).where(
+                cls.path.op('<@', is_comparison=True)(batch.c.source)
+            ).values(
+                path=case(
+                    (cls.path == batch.c.source, batch.c.target),
+                    else_=batch.c.target.op('||')(
+                        func.subpath(cls.path, func.nlevel(batch.c.source))
+                    )
+                )
+            ).execution_options(
+                synchronize_session=False
+            )
+        )
+        cls.sync_moved_subtrees(session, dict(moves))
 
     def __repr__(self):
         return f"{self.__class__.__name__}(id={self.id!r}, node_name={self.node_name!r}, path={self.path!r})"  # pylint: disable=no-member
 
 
 @declarative_mixin
-class LtreeMixin(Common):
+class NamePathMixin:
     '''
-    Unordered tree nodes using Ltree path.
+    Store name_path in an indexed column instead of computing it.
+
+    List before LtreeMixin or OLtreeMixin in the bases so that the column
+    replaces the computed name_path. The column is maintained by the triggers
+    installed by add_name_path_triggers().
     '''
 
     @declared_attr
-    def __table_args__(cls):  # pylint: disable=no-self-argument
-        return (
-            UniqueConstraint('path', deferrable=True, initially='immediate'),
+    def name_path(cls):  # pylint: disable=no-self-argument
+        return Column(
+            Text, index=True,
+            server_default=FetchedValue(), server_onupdate=FetchedValue()
         )
 
+
+@declarative_mixin
+class LtreeMixin(Common):
+    '''
+    Unordered tree nodes using Ltree path.
+    '''
+
     @Common.parent_path.setter  # pylint: disable=no-member
     def parent_path(self, value):
         self.set_new_path(Ltree(value) + subpath(self.path, -1))
 
+    @classmethod
+    def move_many(cls, session, moves):
+        '''
+        Re-parent many nodes, with their subtrees, in one UPDATE.
+
+        moves is an iterable of (node, new parent path) pairs.
+        '''
+        cls.apply_moves(session, [
+            (node.path, Ltree(str(parent)) + subpath(node.path, -1))
+            for node, parent in moves
+        ])
+
+    @classmethod
+    async def amove_many(cls, session, moves):
+        '''
+        Async move_many() with an AsyncSession.
+        '''
+        return await session.run_sync(cls.move_many, list(moves))
+
 
 @declarative_mixin
 class OLtreeMixin(Common):
@@ -204,40 +745,112 @@ class OLtreeMixin(Common):
     Ordered tree nodes using Ltree path.
     '''
 
-    @declared_attr
-    def __table_args__(cls):  # pylint: disable=no-self-argument
-        return (
-            Index(f'{cls.__tablename__}_path_idx', cls.path, postgresql_using='gist'),
-            UniqueConstraint('path', deferrable=True, initially='immediate'),
+    # Settings of the database functions for this table.
+    #
+    # function_prefix, function_postfix: namespace of the functions. Each
+    #     table needs a different prefix: add_functions() raises ValueError
+    #     if the functions of the prefix belong to another table.
+    # max_digits, step_digits, encoding: as for add_oltree_functions().
+    #
+    # add_functions() installs the functions with these settings for this
+    # table, and the methods below call the functions in this namespace.
+    function_prefix = DEFAULT_PREFIX
+    function_postfix = DEFAULT_POSTFIX
+    max_digits = DEFAULT_MAX_DIGITS
+    step_digits = DEFAULT_STEP_DIGITS
+    encoding = DEFAULT_ENCODING
+
+    @classmethod
+    def function_name(cls, name):
+        '''
+        Name of the database function name in this table's namespace.
+        '''
+        return wrap_name(
+            name, prefix=cls.function_prefix, postfix=cls.function_postfix
         )
 
-    @hybrid_property
-    def previous_sibling(self):
+    @classmethod
+    def db_function(cls, name):
+        '''
+        sqlalchemy func for the database function name of this table.
+        '''
+        return getattr(func, cls.function_name(name))
+
+    @classmethod
+    def add_functions(cls, engine, **kwargs):
+        '''
+        Install the database functions for this table with its settings.
+
+        Extra keyword arguments are passed to add_oltree_functions(), and may
+        override the class settings.
+        '''
+        args = dict(
+            full_table_name=cls.__table__.fullname,
+            prefix=cls.function_prefix,
+            postfix=cls.function_postfix,
+            max_digits=cls.max_digits,
+            step_digits=cls.step_digits,
+            encoding=cls.encoding,
+        )
+        args.update(kwargs)
+        return add_oltree_functions(engine, **args)
+
+    @classmethod
+    def previous_sibling_path_query(cls, path):
+        '''
+        Select the path of the previous sibling of the node at path.
+
+        The row just before path in path order is either its parent or in the
+        subtree of its previous sibling, so this is one btree range probe.
+        path may be a column (e.g. cls.path for a correlated subquery).
+        '''
+        sibling = aliased(cls)
+        return select(
+            func.subpath(sibling.path, 0, func.nlevel(path))
+        ).where(
+            sibling.path > parent_path_of(path),
+            sibling.path < path,
+        ).order_by(
+            sibling.path.desc()
+        ).limit(1)
+
+    @classmethod
+    def next_sibling_path_query(cls, path):
+        '''
+        Select the path of the next sibling of the node at path.
+
+        Appending '0' to the last label gives a bound which sorts after every
+        descendant of path but not after any later sibling, so the first row
+        from that bound is the next sibling if there is one.
+        '''
+        sibling = aliased(cls)
+        candidate = aliased(cls)
+        first_after = select(
+            candidate.path
+        ).where(
+            candidate.path >= func.text2ltree(func.ltree2text(path).concat('0'))
+        ).order_by(
+            candidate.path
+        ).limit(1).correlate_except(candidate).scalar_subquery()
+        return select(
+            sibling.path
+        ).where(
+            sibling.path == first_after,
+            parent_path_of(sibling.path) == parent_path_of(path),
+        )
+
+    def _sibling(self, path_query):
         cls = self.__class__
-        cls2 = aliased(cls)
         s = object_session(self)
-        pl = select(
-            cls.path, func.lag(cls.path).over(order_by=cls.path).label('lag')
-        ).where(
-            func.subpath(cls.path, 0, -1) == func.subpath(self.path, 0, -1)
-        ).subquery()
         return s.execute(
-            select(cls2).join(pl, cls2.path == pl.c.lag).where(pl.c.path == self.path)
+            select(cls).where(
+                cls.path == path_query(literal(self.path, LtreeType)).scalar_subquery()
+            )
         ).scalar_one_or_none()
 
-    # @previous_sibling.expression
-    # def previous_sibling(cls):
-    #     cls2 = aliased(cls)
-    #     cls_tmp = aliased(cls)
-    #     pl = select(
-    #         cls_tmp.path, func.lag(cls_tmp.path).over(order_by=cls_tmp.path).label('lag')
-    #     ).where(
-    #         func.subpath(cls_tmp.path, 0, -1) == func.subpath(cls.path, 0, -1)
-    #         # True
-    #     ).subquery()
-    #     return (
-    #         select(cls2).join(pl, cls2.path == pl.c.lag).where(pl.c.path == cls.path)
-    #     )
+    @hybrid_property
+    def previous_sibling(self):
+        return self._sibling(self.previous_sibling_path_query)
 
     @hybrid_property
     def previous_sibling_path(self):
@@ -246,24 +859,277 @@ class OLtreeMixin(Common):
 
     @previous_sibling_path.setter
     def previous_sibling_path(self, value):
-        cls = self.__class__
-        previous_sibling_path = Ltree(value)
+        self.move_to(value)
+
+    @previous_sibling_path.expression
+    def previous_sibling_path(cls):  # pylint: disable=no-self-argument
+        return cls.previous_sibling_path_query(cls.path).scalar_subquery()
+
+    def move_to(self, after):
+        '''
+        Move this node, with its subtree, to a free path after the node at after.
+
+        after may also be parent.__FIRST__ or parent.__LAST__. The same as
+        setting previous_sibling_path.
+        '''
         s = object_session(self)
-        new_path = s.execute(
-            func.oltree_free_path(previous_sibling_path)
+        self.set_new_path(self.free_path(s, after))
+
+    async def amove_to(self, after):
+        '''
+        Async move_to().
+        '''
+        return await self._arun(self.move_to, after)
+
+    async def aprevious_sibling(self):
+        '''
+        Async previous_sibling.
+        '''
+        return await self._arun(lambda: self.previous_sibling)
+
+    async def anext_sibling(self):
+        '''
+        Async next_sibling.
+        '''
+        return await self._arun(lambda: self.next_sibling)
+
+    @classmethod
+    async def afree_path(cls, session, after):
+        '''
+        Async free_path() with an AsyncSession.
+        '''
+        return await session.run_sync(cls.free_path, after)
+
+    @classmethod
+    async def afree_paths(cls, session, after, n):
+        '''
+        Async free_paths() with an AsyncSession.
+        '''
+        return await session.run_sync(cls.free_paths, after, n)
+
+    @classmethod
+    def free_path(cls, session, after):
+        '''
+        Get a free path after the node at after, rebalancing if needed.
+
+        after may also be parent.__FIRST__ or parent.__LAST__.
+        '''
+        return session.execute(
+            cls.db_function('free_path')(Ltree(str(after)))
         ).scalar_one()
-        self.set_new_path(new_path)
+
+    @classmethod
+    def free_paths(cls, session, after, n):
+        '''
+        Get n evenly spaced free paths after the node at after, in one round trip.
+
+        after may also be parent.__FIRST__ or parent.__LAST__. The parent is
+        rebalanced at most once if the gap is too small. The paths are not
+        locked: insert nodes at them in the same transaction.
+        '''
+        return session.execute(
+            select(
+                cls.db_function('free_paths')(
+                    literal(Ltree(str(after)), LtreeType), n, type_=LtreeType
+                )
+            )
+        ).scalars().all()
+
+    @classmethod
+    def move_many(cls, session, moves):
+        '''
+        Move many nodes, with their subtrees, in two statements.
+
+        moves is an iterable of (node, after) pairs where after is anything
+        previous_sibling_path accepts, including parent.__FIRST__ and
+        parent.__LAST__. One call to the move_targets function allocates every new
+        path and one UPDATE applies them.
+        '''
+        moves = list(moves)
+        if not moves:
+            return
+        targets = cls.db_function('move_targets')(
+            cast(
+                bindparam('sources', [str(node.path) for node, _ in moves], type_=ARRAY(Text)),
+                ARRAY(LtreeType)
+            ),
+            cast(
+                bindparam('afters', [str(after) for _, after in moves], type_=ARRAY(Text)),
+                ARRAY(LtreeType)
+            ),
+        ).table_valued(
+            column('move_idx', Integer),
+            column('move_source', LtreeType),
+            column('move_path', LtreeType),
+            column('rebalanced', ARRAY(LtreeType)),
+        )
+        rows = session.execute(
+            select(
+                targets.c.move_source, targets.c.move_path,
+                cast(targets.c.rebalanced, ARRAY(Text)),
+            )
+        ).all()
+        rebalanced = rows[0][2] if rows else []
+        if rebalanced:
+            # Siblings under these parents were renumbered, so their paths
+            # loaded in the session can no longer be trusted.
+            prefixes = tuple(f'{parent}.' for parent in rebalanced)
+            for obj in list(session.identity_map.values()):
+                if not isinstance(obj, cls):
+                    continue
+                path = instance_state(obj).dict.get('path')
+                if path is not None and str(path).startswith(prefixes):
+                    session.expire(obj, ['path'])
+        rows = [(source, target) for source, target, _ in rows]
+        cls.apply_moves(session, rows)
+
+    @classmethod
+    async def amove_many(cls, session, moves):
+        '''
+        Async move_many() with an AsyncSession.
+        '''
+        return await session.run_sync(cls.move_many, list(moves))
 
     @hybrid_property
     def next_sibling(self):
-        cls = self.__class__
-        cls2 = aliased(cls)
-        s = object_session(self)
-        pl = select(
-            cls.path, func.lead(cls.path).over(order_by=cls.path).label('lead')
-        ).where(
-            func.subpath(cls.path, 0, -1) == func.subpath(self.path, 0, -1)
-        ).subquery()
-        return s.execute(
-            select(cls2).join(pl, cls2.path == pl.c.lead).where(pl.c.path == self.path)
-        ).scalar_one_or_none()
+        return self._sibling(self.next_sibling_path_query)
+
+    @hybrid_property
+    def next_sibling_path(self):
+        nxt = self.next_sibling
+        return nxt.path if nxt else None  # pylint: disable=no-member
+
+    @next_sibling_path.expression
+    def next_sibling_path(cls):  # pylint: disable=no-self-argument
+        return cls.next_sibling_path_query(cls.path).scalar_subquery()
+
+
+@declarative_mixin
+class FLtreeMixin(OLtreeMixin):
+    '''
+    Ordered tree nodes using fractional index keys as labels.
+
+    Child labels are keys from ltree_models.fractional, which can always be
+    made longer to fit between two siblings. Paths are chosen client side with
+    one query for the neighbouring siblings and no database functions, so
+    add_oltree_functions() isn't needed. compact() shortens labels which have
+    grown long.
+    '''
+
+    @classmethod
+    def gap_labels(cls, session, after):
+        '''
+        (parent, lo, hi) for the gap after "after".
+
+        after is a child path, parent.__FIRST__ or parent.__LAST__. lo and hi
+        are the labels of the siblings bounding the gap, or None.
+        '''
+        after = Ltree(str(after))
+        if len(after) < 2:
+            raise ValueError(f'"{after}" is not a child node.')
+        parent = after[:-1]
+        leaf = after[-1].path
+        children = select(cls.path).where(
+            parent_path_of(cls.path) == literal(parent, LtreeType)
+        )
+        if leaf == '__FIRST__':
+            lo = None
+            hi = session.execute(children.order_by(cls.path).limit(1)).scalar()
+        elif leaf == '__LAST__':
+            lo = session.execute(children.order_by(cls.path.desc()).limit(1)).scalar()
+            hi = None
+        else:
+            lo = after
+            hi = session.execute(
+                cls.next_sibling_path_query(literal(after, LtreeType))
+            ).scalar()
+        return (
+            parent,
+            Ltree(lo)[-1].path if lo is not None else None,
+            Ltree(hi)[-1].path if hi is not None else None,
+        )
+
+    @classmethod
+    def free_paths(cls, session, after, n):
+        '''
+        Get n free paths after the node at after, in order.
+
+        after may also be parent.__FIRST__ or parent.__LAST__.
+        '''
+        parent, lo, hi = cls.gap_labels(session, after)
+        return [parent + Ltree(key) for key in n_keys_between(lo, hi, n)]
+
+    @classmethod
+    def free_path(cls, session, after):
+        '''
+        Get a free path after the node at after.
+        '''
+        parent, lo, hi = cls.gap_labels(session, after)
+        return parent + Ltree(key_between(lo, hi))
+
+    @classmethod
+    def move_many(cls, session, moves):
+        '''
+        Move many nodes, with their subtrees, in one UPDATE.
+
+        moves is an iterable of (node, after) pairs where after is anything
+        previous_sibling_path accepts. Nodes moving into the same gap keep
+        their order in moves.
+        '''
+        groups = {}
+        for node, after in moves:
+            parent, lo, hi = cls.gap_labels(session, after)
+            groups.setdefault((str(parent), lo, hi), []).append(node)
+        rows = []
+        for (parent, lo, hi), nodes in groups.items():
+            keys = n_keys_between(lo, hi, len(nodes))
+            rows.extend(
+                (node.path, Ltree(parent) + Ltree(key))
+                for node, key in zip(nodes, keys)
+            )
+        cls.apply_moves(session, rows)
+
+    @classmethod
+    def compact(cls, session, parent_path):
+        '''
+        Give the children of parent_path the shortest keys which keep their order.
+
+        Subtrees move with their roots in one UPDATE. Returns the number of
+        children relabelled.
+        '''
+        parent_path = Ltree(str(parent_path))
+        paths = session.execute(
+            select(cls.path).where(
+                parent_path_of(cls.path) == literal(parent_path, LtreeType)
+            ).order_by(cls.path)
+        ).scalars().all()
+        keys = n_keys_between(None, None, len(paths))
+        moves = [
+            (path, parent_path + Ltree(key))
+            for path, key in zip(paths, keys)
+            if path[-1].path != key
+        ]
+        cls.apply_moves(session, moves)
+        return len(moves)
+
+    @classmethod
+    def compact_long_labels(cls, session, max_length=DEFAULT_MAX_LABEL_LENGTH):
+        '''
+        Compact every parent which has a child label longer than max_length.
+
+        Meant to be run periodically. Returns the paths of the parents
+        compacted.
+        '''
+        parents = session.execute(
+            select(
+                parent_path_of(cls.path).label('parent')
+            ).where(
+                func.length(func.ltree2text(func.subpath(cls.path, -1))) > max_length
+            ).distinct()
+        ).scalars().all()
+        # Deepest first: compacting a parent only moves paths below it, so
+        # the paths of the parents still to do stay valid.
+        parents = sorted((Ltree(str(p)) for p in parents), key=len, reverse=True)
+        for parent in parents:
+            cls.compact(session, parent)
+        return parents
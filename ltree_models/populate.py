@@ -1,22 +1,45 @@
 import ltree_models
 
+from collections import namedtuple
+from itertools import islice
 from sqlalchemy import (
+    insert,
     select,
-    func,
 )
 from sqlalchemy.orm import (
+    object_session,
     Session,
 )
 from sqlalchemy_utils import (
     LtreeType,
     Ltree,
 )
+from .allocator import OrdinalAllocator
+from .snapshot import TreeSnapshot
 
 __all__ = (
     'LtreeBuilder',
     'OLtreeBuilder',
+    'DEFAULT_BATCH_SIZE',
 )
 
+DEFAULT_BATCH_SIZE = 10000
+
+# Lightweight stand in for a node when paths are computed client side.
+BulkNode = namedtuple('BulkNode', ('node_name', 'path'))
+
+
+def batched(iterable, batch_size):
+    '''
+    Yield lists of at most batch_size items from iterable.
+    '''
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
 
 class LtreeBuilder:
 
@@ -49,13 +72,71 @@ class LtreeBuilder:
             session.commit()
             self.recursive_add_children(session, node, depth - 1, n_children, path_chooser=path_chooser)
 
-    def populate(self, depth, n_children, path_chooser=None):
+    def populate_session(self, session, depth, n_children, path_chooser=None):
+        '''
+        Populate a tree using session.
+        '''
         path_chooser = path_chooser or self.default_path_chooser
+        root = self.Node(node_name='r', path=Ltree('r'))
+        session.add(root)
+        self.recursive_add_children(session, root, depth, n_children, path_chooser)
+        session.commit()
+
+    def populate(self, depth, n_children, path_chooser=None):
         with Session(self.engine, future=True) as s:
-            root = self.Node(node_name='r', path=Ltree('r'))
-            s.add(root)
-            self.recursive_add_children(s, root, depth, n_children, path_chooser)
-            s.commit()
+            self.populate_session(s, depth, n_children, path_chooser)
+
+    async def apopulate(self, session, depth, n_children, path_chooser=None):
+        '''
+        Async populate() using an AsyncSession.
+        '''
+        await session.run_sync(
+            self.populate_session, depth, n_children, path_chooser
+        )
+
+    def iter_bulk_nodes(self, depth, n_children, path_chooser=None):
+        '''
+        Generate the nodes of a tree breadth first without touching the database.
+
+        Yields BulkNode tuples (node_name, path), starting with the root. Only
+        path choosers which compute paths client side can be used.
+        '''
+        path_chooser = path_chooser or self.default_path_chooser
+        level = [BulkNode(node_name='r', path=Ltree('r'))]
+        yield from level
+        for _ in range(depth):
+            next_level = []
+            for parent in level:
+                for i in range(n_children):
+                    path = path_chooser(parent, i, n_children)
+                    if not isinstance(path, Ltree):
+                        raise ValueError(
+                            f'path chooser returned {path!r}: bulk population '
+                            'needs paths computed client side.'
+                        )
+                    node = BulkNode(
+                        node_name=f'{parent.node_name}.{str(i)}',
+                        path=path
+                    )
+                    next_level.append(node)
+                    yield node
+            level = next_level
+
+    def populate_bulk(
+        self, depth, n_children, path_chooser=None,
+        batch_size=DEFAULT_BATCH_SIZE
+    ):
+        '''
+        Populate the same tree as populate() using batched multi-row INSERTs.
+
+        All paths and names are computed client side and written in batches of
+        batch_size rows within a single transaction.
+        '''
+        table = self.Node.__table__
+        nodes = self.iter_bulk_nodes(depth, n_children, path_chooser)
+        with self.engine.begin() as con:
+            for batch in batched(nodes, batch_size):
+                con.execute(insert(table), [node._asdict() for node in batch])
 
     def all_nodes(self, session=None):
         query = select(self.Node).order_by(self.Node.path)
@@ -64,11 +145,52 @@ class LtreeBuilder:
         with Session(self.engine, future=True) as s:
             return s.execute(query).scalars().all()
 
+    def iter_nodes(self, session=None, columns=None, batch_size=DEFAULT_BATCH_SIZE):
+        '''
+        Iterate over all nodes in path order from a server side cursor.
+
+        See iter_subtree() for columns.
+        '''
+        if session:
+            yield from self.Node.iter_subtree(
+                session, columns=columns, batch_size=batch_size
+            )
+            return
+        with Session(self.engine, future=True) as s:
+            yield from self.Node.iter_subtree(
+                s, columns=columns, batch_size=batch_size
+            )
+
+    async def aall_nodes(self, session):
+        '''
+        Async all_nodes() using an AsyncSession.
+        '''
+        result = await session.execute(
+            select(self.Node).order_by(self.Node.path)
+        )
+        return result.scalars().all()
+
+    def snapshot(self, session=None):
+        '''
+        TreeSnapshot of the whole table.
+        '''
+        if session:
+            return TreeSnapshot.load(session, self.Node)
+        with Session(self.engine, future=True) as s:
+            return TreeSnapshot.load(s, self.Node)
+
+    def all_nodes_with_name_paths(self, session=None):
+        if session:
+            return self.Node.with_name_paths(session)
+        with Session(self.engine, future=True) as s:
+            return self.Node.with_name_paths(s)
+
     def print_tree(self, session=None, with_name_path=False):
-        for o in self.all_nodes(session=session):
-            if with_name_path:
-                print(o, o.name_path)
-            else:
+        if with_name_path:
+            for o, name_path in self.all_nodes_with_name_paths(session=session):
+                print(o, name_path)
+        else:
+            for o in self.iter_nodes(session=session):
                 print(o)
 
 
@@ -76,31 +198,58 @@ class OLtreeBuilder(LtreeBuilder):
 
     def path_chooser_balanced(self, parent, i, n_children):
         step = round(((self.max_number + 1) / (n_children + 1)))
-        return parent.path + Ltree(f'{(step * (i + 1)):0{self.max_digits}d}')
+        return parent.path + Ltree(ltree_models.encode_ordinal(
+            step * (i + 1), self.max_digits, self.encoding
+        ))
 
     def path_chooser_free_path(self, parent, i, n_children):
-        return func.oltree_free_path(parent.path + '__LAST__')
+        return self.Node.db_function('free_path')(parent.path + '__LAST__')
+
+    def path_chooser_cached(self, parent, i, n_children):
+        return self.allocator.next_path(object_session(parent), parent.path)
 
     default_path_chooser = path_chooser_balanced
 
     def __init__(
         self,
         engine, node_class,
-        max_digits=ltree_models.DEFAULT_MAX_DIGITS,
-        step_digits=ltree_models.DEFAULT_STEP_DIGITS
+        max_digits=None,
+        step_digits=None,
+        encoding=None,
     ):
         super().__init__(engine, node_class)
-        self.set_digits(max_digits, step_digits)
+        self.set_digits(max_digits, step_digits, encoding)
 
     def set_digits(
         self,
-        max_digits=ltree_models.DEFAULT_MAX_DIGITS,
-        step_digits=ltree_models.DEFAULT_STEP_DIGITS
+        max_digits=None,
+        step_digits=None,
+        encoding=None,
     ):
+        '''
+        Set the digits used for new paths and install the functions for them.
+
+        Arguments default to the settings of the node class.
+        '''
+        if max_digits is None:
+            max_digits = self.Node.max_digits
+        if step_digits is None:
+            step_digits = self.Node.step_digits
+        if encoding is None:
+            encoding = self.Node.encoding
         self.max_digits = max_digits
-        self.max_number = 10 ** max_digits - 1
         self.step_digits = step_digits
-        self.step_number = 10 ** step_digits
-        ltree_models.add_oltree_functions(
-            self.engine, max_digits=max_digits, step_digits=step_digits
+        self.encoding = encoding
+        self.max_number, self.step_number = ltree_models.ordinal_limits(
+            max_digits, step_digits, encoding
+        )
+        # The builder is the only writer while it populates, so cached gaps
+        # stay valid across its per node commits.
+        self.allocator = OrdinalAllocator(
+            self.Node, max_digits=max_digits, step_digits=step_digits,
+            encoding=encoding, invalidate_on_commit=False
+        )
+        self.Node.add_functions(
+            self.engine, max_digits=max_digits, step_digits=step_digits,
+            encoding=encoding
         )
@@ -0,0 +1,372 @@
+'''
+Read only, in memory snapshots of a tree.
+
+A TreeSnapshot is built from one query of (path, id, node_name) in path order
+and then answers structural questions without the database. Ordering by path
+lists every node before its descendants and keeps each subtree contiguous, so
+a node's subtree is the block of rows from the node to the node plus its
+subtree size.
+
+Nodes are held in compact arrays indexed by row number: the distance back to
+the parent row, the depth, the subtree size and an interned label. Paths are
+rebuilt from the labels when needed, and a dict from path to row finds a node
+in O(1). Nothing in the arrays refers to absolute row numbers, so a subtree can
+be moved as one block (see SnapshotCache in ltree_models.changefeed); only the
+dict entries of the rows after a change need redoing, which is left to the
+next lookup.
+'''
+from array import array
+from collections import namedtuple
+from sqlalchemy import select
+from sqlalchemy_utils import Ltree
+
+__all__ = (
+    'TreeSnapshot',
+    'SnapshotNode',
+)
+
+SnapshotNode = namedtuple('SnapshotNode', ('id', 'node_name', 'path'))
+
+# Per row arrays, in the order blocks of rows are cut out and put back.
+ROW_ARRAYS = ('ids', 'node_names', 'parent_offsets', 'depths', 'sizes', 'label_ids')
+
+
+def split_path(path):
+    return tuple(str(path).split('.'))
+
+
+class TreeSnapshot:
+    '''
+    Snapshot of a tree, or of a subtree.
+
+    rows is an iterable of (path, id, node_name) in path order. A node whose
+    parent isn't in rows (a root, or the top of a loaded subtree) is a top
+    level node; if intermediate nodes are missing the nearest loaded ancestor
+    is used as the parent.
+
+    Methods taking a path raise KeyError if it isn't in the snapshot. The
+    methods which change the snapshot (insert_node() etc.) are for applying
+    changes to a copy(): readers of a snapshot never see it change.
+    '''
+
+    def __init__(self, rows=()):
+        self.ids = array('q')
+        self.node_names = []
+        # Rows back to the parent row, or 0 for top level nodes.
+        self.parent_offsets = array('i')
+        self.depths = array('i')
+        # Each row's subtree is rows [i, i + sizes[i]).
+        self.sizes = array('i')
+        # Path labels below the parent (usually one), interned.
+        self.label_ids = array('i')
+        self.labels = []
+        self.label_index = {}
+        # Row of each path. Only the entries of rows before indexed_rows are
+        # up to date; the paths of removed rows are never left in.
+        self.path_rows = {}
+        # Labels of the rows on the path from the top to the current row.
+        stack = []
+        for i, (path, node_id, node_name) in enumerate(rows):
+            labels = split_path(path)
+            while stack and not (
+                len(stack[-1][1]) < len(labels) and
+                labels[:len(stack[-1][1])] == stack[-1][1]
+            ):
+                top = stack.pop()[0]
+                self.sizes[top] = i - top
+            parent, parent_labels = stack[-1] if stack else (i, ())
+            self.ids.append(node_id)
+            self.node_names.append(node_name)
+            self.parent_offsets.append(i - parent)
+            self.depths.append(len(labels))
+            self.sizes.append(1)
+            self.label_ids.append(self._label_id(labels[len(parent_labels):]))
+            self.path_rows['.'.join(labels)] = i
+            stack.append((i, labels))
+        for i, _ in stack:
+            self.sizes[i] = len(self.ids) - i
+        self.indexed_rows = len(self.ids)
+
+    @classmethod
+    def load(cls, session, node_class, path=None):
+        '''
+        Snapshot the table of node_class, or only the subtree at path.
+
+        session may also be a Connection.
+        '''
+        query = select(
+            node_class.path, node_class.id, node_class.node_name
+        ).order_by(node_class.path)
+        if path is not None:
+            query = query.where(
+                node_class.path.op('<@', is_comparison=True)(Ltree(str(path)))
+            )
+        return cls(session.execute(query))
+
+    def copy(self):
+        other = self.__class__.__new__(self.__class__)
+        for name in ROW_ARRAYS:
+            setattr(other, name, getattr(self, name)[:])
+        other.labels = self.labels[:]
+        other.label_index = dict(self.label_index)
+        other.path_rows = dict(self.path_rows)
+        other.indexed_rows = self.indexed_rows
+        return other
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, path):
+        try:
+            self.index(path)
+        except KeyError:
+            return False
+        return True
+
+    def _label_id(self, labels):
+        label = '.'.join(labels)
+        label_id = self.label_index.get(label)
+        if label_id is None:
+            label_id = self.label_index[label] = len(self.labels)
+            self.labels.append(label)
+        return label_id
+
+    def _parent_row(self, i):
+        offset = self.parent_offsets[i]
+        return i - offset if offset else -1
+
+    def _labels(self, i):
+        parts = []
+        while i >= 0:
+            parts.append(self.labels[self.label_ids[i]])
+            i = self._parent_row(i)
+        return split_path('.'.join(reversed(parts)))
+
+    def _row_paths(self, start, end):
+        '''
+        (row, path) for rows [start, end), each path built from its parent's.
+        '''
+        paths = {}
+        for i in range(start, end):
+            parent = self._parent_row(i)
+            label = self.labels[self.label_ids[i]]
+            if parent < 0:
+                path = label
+            else:
+                parent_path = paths.get(parent)
+                if parent_path is None:
+                    parent_path = paths[parent] = '.'.join(self._labels(parent))
+                path = parent_path + '.' + label
+            paths[i] = path
+            yield i, path
+
+    def _position(self, labels):
+        '''
+        Row of the first node not before labels in path order.
+        '''
+        lo, hi = 0, len(self.ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._labels(mid) < labels:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def index(self, path):
+        '''
+        Row of the node at path.
+
+        O(1), after redoing the entries of the rows moved by changes since
+        the last lookup.
+        '''
+        if self.indexed_rows < len(self.ids):
+            self.path_rows.update(
+                (p, i) for i, p in self._row_paths(self.indexed_rows, len(self.ids))
+            )
+            self.indexed_rows = len(self.ids)
+        try:
+            return self.path_rows[str(path)]
+        except KeyError:
+            raise KeyError(str(path)) from None
+
+    def path_at(self, i):
+        return Ltree('.'.join(self._labels(i)))
+
+    def node_at(self, i):
+        return SnapshotNode(self.ids[i], self.node_names[i], self.path_at(i))
+
+    def _nodes(self, rows):
+        return [self.node_at(i) for i in rows]
+
+    def node(self, path):
+        return self.node_at(self.index(path))
+
+    def depth(self, path):
+        '''
+        nlevel() of path.
+        '''
+        return self.depths[self.index(path)]
+
+    def subtree_size(self, path):
+        '''
+        Number of nodes in the subtree at path, including the node itself.
+        '''
+        return self.sizes[self.index(path)]
+
+    def is_ancestor(self, ancestor, path):
+        '''
+        Whether the node at ancestor is path or one of its ancestors.
+        '''
+        a = self.index(ancestor)
+        return a <= self.index(path) < a + self.sizes[a]
+
+    def parent(self, path):
+        '''
+        The parent node, or None for a top level node.
+        '''
+        parent = self._parent_row(self.index(path))
+        return None if parent < 0 else self.node_at(parent)
+
+    def ancestors(self, path):
+        '''
+        Ancestors of the node at path, top first.
+        '''
+        rows = []
+        i = self._parent_row(self.index(path))
+        while i >= 0:
+            rows.append(i)
+            i = self._parent_row(i)
+        return self._nodes(reversed(rows))
+
+    def descendants(self, path, max_depth=None):
+        '''
+        Descendants down to max_depth levels below path, in path order.
+        '''
+        i = self.index(path)
+        rows = range(i + 1, i + self.sizes[i])
+        if max_depth is not None:
+            limit = self.depths[i] + max_depth
+            rows = (j for j in rows if self.depths[j] <= limit)
+        return self._nodes(rows)
+
+    def _child_rows(self, i, start=None):
+        '''
+        Rows of the children of row i (-1 for the top level) from start on.
+        '''
+        end = len(self.ids) if i < 0 else i + self.sizes[i]
+        j = i + 1 if start is None else start
+        while j < end:
+            yield j
+            j += self.sizes[j]
+
+    def children_of(self, path):
+        '''
+        Children of the node at path, in path order.
+        '''
+        return self._nodes(self._child_rows(self.index(path)))
+
+    def siblings(self, path):
+        '''
+        Other children of the parent of the node at path, in path order.
+        '''
+        i = self.index(path)
+        return self._nodes(
+            j for j in self._child_rows(self._parent_row(i)) if j != i
+        )
+
+    def roots(self):
+        '''
+        Top level nodes, in path order.
+        '''
+        return self._nodes(self._child_rows(-1))
+
+    def _shift(self, parent, start, k):
+        '''
+        Account for k rows appearing (or -k disappearing) under row parent.
+
+        Called before the rows change, with start the first row after them.
+        parent and its ancestors grow by k, and rows from start on whose
+        parents are before the change get k further from them: the following
+        siblings of the changed rows and of each of their ancestors.
+        '''
+        while parent >= 0:
+            for j in self._child_rows(parent, start=start):
+                self.parent_offsets[j] += k
+            start = parent + self.sizes[parent]
+            self.sizes[parent] += k
+            parent = self._parent_row(parent)
+
+    def _detach(self, i):
+        '''
+        Remove the subtree at row i, returning its rows.
+        '''
+        k = self.sizes[i]
+        block = {name: getattr(self, name)[i:i + k] for name in ROW_ARRAYS}
+        for _, path in self._row_paths(i, i + k):
+            self.path_rows.pop(path, None)
+        self.indexed_rows = min(self.indexed_rows, i)
+        self._shift(self._parent_row(i), i + k, -k)
+        for name in ROW_ARRAYS:
+            del getattr(self, name)[i:i + k]
+        return block
+
+    def _attach(self, path, block):
+        '''
+        Put rows taken by _detach() (or a new node) back with the root at path.
+        '''
+        labels = split_path(path)
+        i = self._position(labels)
+        if i < len(self.ids) and self._labels(i)[:len(labels)] == labels:
+            raise ValueError(f'{path} is already in the snapshot.')
+        parent = i - 1
+        while parent >= 0:
+            parent_labels = self._labels(parent)
+            if labels[:len(parent_labels)] == parent_labels:
+                break
+            parent = self._parent_row(parent)
+        parent_labels = self._labels(parent) if parent >= 0 else ()
+        delta = len(labels) - block['depths'][0]
+        if delta:
+            block['depths'] = array('i', (d + delta for d in block['depths']))
+        block['parent_offsets'][0] = i - parent if parent >= 0 else 0
+        block['label_ids'][0] = self._label_id(labels[len(parent_labels):])
+        k = len(block['ids'])
+        self.indexed_rows = min(self.indexed_rows, i)
+        self._shift(parent, i, k)
+        for name in ROW_ARRAYS:
+            getattr(self, name)[i:i] = block[name]
+
+    def insert_node(self, path, node_id, node_name):
+        '''
+        Add a leaf node. Raises ValueError if path or a descendant exists.
+        '''
+        self._attach(path, {
+            'ids': array('q', [node_id]),
+            'node_names': [node_name],
+            'parent_offsets': array('i', [0]),
+            'depths': array('i', [len(split_path(path))]),
+            'sizes': array('i', [1]),
+            'label_ids': array('i', [0]),
+        })
+
+    def remove_subtree(self, path):
+        self._detach(self.index(path))
+
+    def rename(self, path, node_name):
+        self.node_names[self.index(path)] = node_name
+
+    def move_subtrees(self, moves):
+        '''
+        Move subtrees, all at once, given (old path, new path) pairs.
+
+        As with one UPDATE, sources may move into each other's places. Raises
+        ValueError if one source is inside another.
+        '''
+        rows = sorted((self.index(old), new) for old, new in moves)
+        for (i, _), (j, _) in zip(rows, rows[1:]):
+            if j < i + self.sizes[i]:
+                raise ValueError(f'{self.path_at(j)} is inside a moved subtree.')
+        blocks = [(new, self._detach(i)) for i, new in reversed(rows)]
+        for new, block in sorted(blocks, key=lambda b: split_path(b[0])):
+            self._attach(new, block)
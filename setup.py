@@ -11,6 +11,8 @@ requires = [
 ]
 
 tests_require = [
+    'asyncpg',
+    'ijson',
     'psycopg2',
     'testing.postgresql',
     'tox',
@@ -28,6 +30,8 @@ setup(
     install_requires = requires,
     extras_require = {
         'testing': tests_require,
+        'json': ['ijson'],
+        'asyncio': ['asyncpg'],
     },
     description = 'sqlalchemy models for ltree.',
     long_description=README,
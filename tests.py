@@ -1,3 +1,5 @@
+import io
+import json
 import logging
 import ltree_models
 import os
@@ -10,21 +12,28 @@ from sqlalchemy import (
     create_engine,
     Column,
     engine,
+    event,
     Integer,
     text,
     Text,
     select,
     func,
+    literal,
 )
 from sqlalchemy_utils import (
     LtreeType,
     Ltree,
 )
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    create_async_engine,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.compiler import compiles #data migrations tool used with SQLAlchemy to make database schema changes
 from sqlalchemy.orm import (
     Session,
     sessionmaker,
+    with_parent,
 )
 from sqlalchemy.schema import DropTable
 from sqlalchemy.sql.functions import GenericFunction
@@ -46,6 +55,34 @@ class Node(Base, ltree_models.OLtreeMixin):
     __tablename__ = 'oltree_nodes'
     id = Column(id_type, primary_key=True)
 
+class LNode(Base, ltree_models.LtreeMixin):
+    __tablename__ = 'ltree_nodes'
+    id = Column(id_type, primary_key=True)
+    gist_siglen = 32
+    prefix_index = True
+
+class NamedNode(Base, ltree_models.NamePathMixin, ltree_models.OLtreeMixin):
+    __tablename__ = 'oltree_named_nodes'
+    function_prefix = 'oltree_named_'
+    id = Column(id_type, primary_key=True)
+
+class FNode(Base, ltree_models.FLtreeMixin):
+    __tablename__ = 'fltree_nodes'
+    id = Column(id_type, primary_key=True)
+
+class WideNode(Base, ltree_models.OLtreeMixin):
+    __tablename__ = 'wide_nodes'
+    id = Column(id_type, primary_key=True)
+    function_prefix = 'wide_'
+    max_digits = 2
+    step_digits = 1
+
+def two_digit_paths(parent, i, n_children):
+    '''
+    Sequential ordinals padded for set_digits(2,1), leaving the gaps full.
+    '''
+    return parent.path + Ltree(f'{i:02d}')
+
 # drops tables with cascade
 @compiles(DropTable, "postgresql")
 def _compile_drop_table(element, compiler, **kwargs):
@@ -84,6 +121,18 @@ class DBBase(unittest.TestCase):
     def tearDown(self):
         Base.metadata.drop_all(self.engine)
 
+    def explain(self, session, query):
+        '''
+        Query plan for query with sequential scans discouraged.
+        '''
+        session.execute(text('SET LOCAL enable_seqscan = off'))
+        compiled = query.compile(dialect=self.engine.dialect)
+        return '\n'.join(
+            row[0] for row in session.connection().exec_driver_sql(
+                'EXPLAIN ' + str(compiled), compiled.params
+            )
+        )
+
 
 @unittest.skipUnless(debugging, 'Not debugging')
 class Debugging(DBBase):
@@ -149,6 +198,39 @@ class DBFunctions(DBBase):
             s.commit()
         self.assertEqual([str(o.path) for o in self.tree_builder.all_nodes()], ['r', 'r.25', 'r.50', 'r.75'])
 
+    def test_rebalance_moves_descendants(self):
+        '''
+        Should carry every child's subtree along with it.
+        '''
+        self.tree_builder.set_digits(2,1)
+        self.tree_builder.populate(3,2, path_chooser=self.tree_builder.path_chooser_sequential)
+        with Session(self.engine, future=True) as s:
+            s.execute(text("CALL oltree_rebalance(:path)"), {'path': 'r.1'})
+            s.commit()
+        paths = {o.node_name: str(o.path) for o in self.tree_builder.all_nodes()}
+        self.assertEqual(len(paths), 15)
+        self.assertEqual(paths['r.1.0'], 'r.1.33')
+        self.assertEqual(paths['r.1.1.0'], 'r.1.67.0')
+        self.assertEqual(paths['r.0.1.0'], 'r.0.1.0')
+        with Session(self.engine, future=True) as s:
+            for node in self.tree_builder.all_nodes(s)[1:]:
+                self.assertIsNotNone(node.parent, node.node_name)
+
+    def test_rebalance_other_table(self):
+        '''
+        Should rebalance the table the functions were installed for.
+        '''
+        NamedNode.add_functions(self.engine, max_digits=2, step_digits=1)
+        builder = ltree_models.LtreeBuilder(self.engine, NamedNode)
+        builder.populate(2,2)
+        with Session(self.engine, future=True) as s:
+            s.execute(text("CALL oltree_named_rebalance(:path)"), {'path': 'r'})
+            s.commit()
+        self.assertEqual(
+            [str(o.path) for o in builder.all_nodes()],
+            ['r', 'r.33', 'r.33.0', 'r.33.1', 'r.67', 'r.67.0', 'r.67.1']
+        )
+
     def test_rebalance_full(self):
         '''
         Should result in a sqlalchemy.exc.DataError when rebalancing full branch.
@@ -164,6 +246,196 @@ class DBFunctions(DBBase):
             else:
                 raise Exception('Should have run out of space.')
 
+    def test_rebalance_gap_local(self):
+        '''
+        Should only spread out siblings near the gap, carrying their subtrees.
+        '''
+        self.tree_builder.set_digits(2,1)
+        self.tree_builder.populate(2,3, path_chooser=two_digit_paths)
+        with Session(self.engine, future=True) as s:
+            s.add(self.Node(node_name='far', path=Ltree('r.90')))
+            s.commit()
+            # Returns where after and the followed paths went.
+            after, follow = s.execute(
+                text("CALL oltree_rebalance_gap(:path, 1, CAST(:follow AS ltree[]))"),
+                {'path': 'r.00', 'follow': ['r.01.02', 'r.90']}
+            ).one()
+            s.commit()
+        self.assertEqual((str(after), follow), ('r.01', '{r.04.02,r.90}'))
+        paths = {o.node_name: str(o.path) for o in self.tree_builder.all_nodes()}
+        # The window [0, 7] held r.00, r.01 and r.02 plus the free slot.
+        self.assertEqual(
+            [paths[name] for name in ('r.0', 'r.0.1', 'r.1', 'r.1.2', 'r.2', 'far')],
+            ['r.01', 'r.01.01', 'r.04', 'r.04.02', 'r.06', 'r.90']
+        )
+
+    def test_free_path_follows_rebalanced_after(self):
+        '''
+        free_path should allocate after "after" where the rebalance moved it.
+        '''
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(0,0)
+        with Session(self.engine, future=True) as s:
+            s.add(self.Node(node_name='r.a', path=Ltree('r.5000')))
+            s.add(self.Node(node_name='r.b', path=Ltree('r.5001')))
+            s.commit()
+            # The window [5000, 5007] spreads the two to r.5002 and r.5006.
+            path = self.Node.free_path(s, Ltree('r.5000'))
+            self.assertEqual(str(path), 'r.5004')
+            s.add(self.Node(node_name='r.new', path=Ltree(path)))
+            s.flush()
+            self.assertEqual(
+                s.execute(
+                    select(self.Node.node_name).where(
+                        func.subpath(self.Node.path, 0, -1) == Ltree('r')
+                    ).order_by(self.Node.path)
+                ).scalars().all(),
+                ['r.a', 'r.new', 'r.b']
+            )
+
+    def test_rebalance_gap_full(self):
+        '''
+        Should run out of space when the whole range can't hold the new nodes.
+        '''
+        self.tree_builder.set_digits(1,0)
+        self.tree_builder.populate(1,9, path_chooser=self.tree_builder.path_chooser_sequential)
+        with Session(self.engine, future=True) as s:
+            with self.assertRaises(sqlalchemy.exc.DataError):
+                s.execute(text("CALL oltree_rebalance_gap(:path, 1)"), {'path': 'r.0'})
+
+    def test_rebalance_queue(self):
+        '''
+        Should queue small gaps and widen them later.
+        '''
+        self.tree_builder.set_digits(2,1)
+        ltree_models.add_oltree_functions(
+            self.engine, max_digits=2, step_digits=1, queue_min_gap=5
+        )
+
+        def drop_queue():
+            with self.engine.begin() as con:
+                con.execute(text('DROP TABLE IF EXISTS oltree_rebalance_queue'))
+        self.addCleanup(drop_queue)
+        with Session(self.engine, future=True) as s:
+            for path in ('r', 'r.00', 'r.04'):
+                s.add(self.Node(node_name=path, path=Ltree(path)))
+            s.commit()
+            # Plenty of room after the last node: nothing queued.
+            s.execute(func.oltree_free_path(Ltree('r.__LAST__'))).scalar_one()
+            self.assertEqual(ltree_models.run_rebalancer(self.engine), [])
+            # Three free ordinals between r.00 and r.04.
+            self.assertEqual(
+                str(s.execute(func.oltree_free_path(Ltree('r.00'))).scalar_one()),
+                'r.02'
+            )
+            s.commit()
+        self.assertEqual(
+            [str(p) for p in ltree_models.run_rebalancer(self.engine)], ['r']
+        )
+        # Only the window around the queued gap after r.00 is renumbered,
+        # leaving at least queue_min_gap free ordinals there.
+        self.assertEqual(
+            [str(o.path) for o in self.tree_builder.all_nodes()],
+            ['r', 'r.03', 'r.21']
+        )
+        self.assertEqual(ltree_models.run_rebalancer(self.engine), [])
+
+    def test_base62_labels(self):
+        '''
+        Should allocate and rebalance with base62 labels which sort in ordinal
+        order.
+        '''
+        self.tree_builder.set_digits(2,1,'base62')
+        self.tree_builder.populate(1,3)
+        self.assertEqual(
+            [str(o.path) for o in self.tree_builder.all_nodes()],
+            ['r', 'r.FV', 'r.V0', 'r.kV']
+        )
+        with Session(self.engine, future=True) as s:
+            self.assertEqual(
+                s.execute(select(
+                    func.oltree_label(3787), func.oltree_ordinal(Ltree('r.z5'))
+                )).one(),
+                ('z5', 3787)
+            )
+            self.assertEqual(
+                str(s.execute(func.oltree_free_path(Ltree('r.__LAST__'))).scalar_one()),
+                'r.lV'
+            )
+            s.execute(text("CALL oltree_rebalance(:path)"), {'path': 'r'})
+            s.commit()
+        self.assertEqual(
+            [str(o.path) for o in self.tree_builder.all_nodes()],
+            ['r', 'r.FV', 'r.V0', 'r.kV']
+        )
+        labels = [ltree_models.encode_ordinal(n, 2, 'base62') for n in range(3844)]
+        self.assertEqual(sorted(labels), labels)
+        self.assertEqual(
+            [ltree_models.decode_ordinal(label, 'base62') for label in labels],
+            list(range(3844))
+        )
+
+    def test_add_oltree_functions_skips_unchanged(self):
+        '''
+        Should only install when something changed, and record what it did.
+        '''
+        ltree_models.add_oltree_functions(self.engine, max_digits=3, step_digits=1)
+        self.assertFalse(
+            ltree_models.add_oltree_functions(self.engine, max_digits=3, step_digits=1)
+        )
+        self.assertTrue(
+            ltree_models.add_oltree_functions(self.engine, max_digits=4, step_digits=1)
+        )
+        self.assertTrue(ltree_models.add_oltree_functions(
+            self.engine, max_digits=4, step_digits=1, force=True
+        ))
+        with self.engine.connect() as con:
+            params = con.execute(
+                text(f'SELECT params FROM {ltree_models.METADATA_TABLE} WHERE name = :name'),
+                {'name': 'oltree_functions'}
+            ).scalar_one()
+        self.assertEqual((params['max_digits'], params['step_digits']), (4, 1))
+
+    def test_per_table_functions(self):
+        '''
+        Each table should use the functions installed with its own settings.
+        '''
+        self.assertTrue(WideNode.add_functions(self.engine))
+        self.assertFalse(WideNode.add_functions(self.engine))
+        with Session(self.engine, future=True) as s:
+            s.add(self.Node(node_name='r', path=Ltree('r')))
+            s.add(WideNode(node_name='r', path=Ltree('r')))
+            s.commit()
+            self.assertEqual(
+                self.Node.free_path(s, Ltree('r.__LAST__')), Ltree('r.500000')
+            )
+            self.assertEqual(
+                WideNode.free_path(s, Ltree('r.__LAST__')), Ltree('r.50')
+            )
+            # Filling the wide table mustn't touch oltree_nodes.
+            for i in range(10):
+                s.add(WideNode(
+                    node_name=f'r.{i}', path=WideNode.free_path(s, Ltree('r.__LAST__'))
+                ))
+                s.flush()
+            self.assertEqual(
+                s.execute(select(func.count()).select_from(self.Node)).scalar_one(), 1
+            )
+
+    def test_prefix_of_another_table(self):
+        '''
+        Should refuse to install a table's functions over another table's.
+        '''
+        Node.add_functions(self.engine)
+        with self.assertRaises(ValueError):
+            ltree_models.add_oltree_functions(
+                self.engine, full_table_name='wide_nodes'
+            )
+        self.assertTrue(ltree_models.add_oltree_functions(
+            self.engine, full_table_name='wide_nodes', force=True
+        ))
+        self.assertTrue(Node.add_functions(self.engine, force=True))
+
     def test_free_path_full(self):
         '''
         Should rebalance to find free spaces.
@@ -251,6 +523,198 @@ class OLtreeMixin(DBBase):
                 {'r.50', 'r.70'}
             )
 
+    def test_children_use_parent_path_index(self):
+        self.tree_builder.populate(2,3)
+        with Session(self.engine, future=True) as s:
+            plan = self.explain(
+                s, select(Node).where(Node.parent_path == Ltree('r'))
+            )
+            self.assertIn('oltree_nodes_parent_path_idx', plan)
+
+    def test_descendants(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(3,2)
+        with Session(self.engine, future=True) as s:
+            root = s.execute(select(Node).where(Node.path==Ltree('r'))).scalar_one()
+            self.assertEqual(
+                [o.node_name for o in root.descendants(max_depth=2)],
+                ['r.0', 'r.0.0', 'r.0.1', 'r.1', 'r.1.0', 'r.1.1']
+            )
+            self.assertEqual(len(root.descendants()), 14)
+            self.assertEqual(
+                [o.node_name for o in root.descendants_at_level(2)],
+                ['r.0.0', 'r.0.1', 'r.1.0', 'r.1.1']
+            )
+            self.assertEqual(root.subtree_size(), 15)
+            self.assertEqual(root.subtree_size(max_depth=1), 3)
+
+    def test_subtree_as_nested(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,2)
+        with Session(self.engine, future=True) as s:
+            root = s.execute(select(Node).where(Node.path==Ltree('r'))).scalar_one()
+            self.assertEqual(
+                root.subtree_as_nested(columns=['node_name']),
+                {'node_name': 'r', 'children': [
+                    {'node_name': 'r.0', 'children': [
+                        {'node_name': 'r.0.0', 'children': []},
+                        {'node_name': 'r.0.1', 'children': []},
+                    ]},
+                    {'node_name': 'r.1', 'children': [
+                        {'node_name': 'r.1.0', 'children': []},
+                        {'node_name': 'r.1.1', 'children': []},
+                    ]},
+                ]}
+            )
+            self.assertEqual(
+                root.subtree_as_nested(max_depth=1, columns=['path'], children_key='items'),
+                {'path': 'r', 'items': [
+                    {'path': 'r.3333', 'items': []},
+                    {'path': 'r.6666', 'items': []},
+                ]}
+            )
+
+    def test_load_ancestors(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,3)
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        with Session(self.engine, future=True) as s:
+            leaves = s.execute(
+                select(Node).where(func.nlevel(Node.path) == 3).order_by(Node.path)
+            ).scalars().all()
+            sqlalchemy.event.listen(self.engine, 'before_cursor_execute', count)
+            try:
+                Node.load_ancestors(s, leaves)
+                names = [[a.node_name for a in leaf.ancestors] for leaf in leaves]
+                parents = [leaf.parent.node_name for leaf in leaves]
+                grandparents = [leaf.parent.parent for leaf in leaves]
+            finally:
+                sqlalchemy.event.remove(self.engine, 'before_cursor_execute', count)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(names[0], ['r', 'r.0'])
+        self.assertEqual(names[-1], ['r', 'r.2'])
+        self.assertEqual(parents, ['r.0'] * 3 + ['r.1'] * 3 + ['r.2'] * 3)
+        self.assertTrue(all(g.node_name == 'r' for g in grandparents))
+
+    def test_set_new_path_syncs_session(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,2)
+        with Session(self.engine, future=True) as s:
+            nodes = self.tree_builder.all_nodes(s)
+            moved = s.execute(select(Node).where(Node.path==Ltree('r.3333'))).scalar_one()
+            moved.set_new_path(Ltree('r.6666.5000'))
+            in_session = {o.node_name: str(o.path) for o in nodes}
+            s.expire_all()
+            self.assertEqual(
+                in_session,
+                {o.node_name: str(o.path) for o in self.tree_builder.all_nodes(s)}
+            )
+            self.assertEqual(in_session['r.0.1'], 'r.6666.5000.6666')
+
+    def test_move_many(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,3)
+        with Session(self.engine, future=True) as s:
+            first, middle, last = [
+                s.execute(select(Node).where(Node.path==Ltree(path))).scalar_one()
+                for path in ('r.2500', 'r.5000', 'r.7500')
+            ]
+            Node.move_many(s, [(last, 'r.__FIRST__'), (middle, 'r.__FIRST__')])
+            s.commit()
+            self.assertEqual(
+                [o.node_name for o in self.tree_builder.all_nodes(s) if o.parent_path == 'r'],
+                ['r.2', 'r.1', 'r.0']
+            )
+            self.assertEqual(last.children[0].node_name, 'r.2.0')
+
+    def test_move_many_same_gap(self):
+        '''
+        __LAST__ and the last child's own path name the same gap.
+        '''
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,3)
+        with Session(self.engine, future=True) as s:
+            first, middle = [
+                s.execute(select(Node).where(Node.path==Ltree(path))).scalar_one()
+                for path in ('r.2500', 'r.5000')
+            ]
+            Node.move_many(s, [(first, 'r.__LAST__'), (middle, 'r.7500')])
+            s.commit()
+            self.assertEqual(
+                [
+                    (o.node_name, str(o.path))
+                    for o in self.tree_builder.all_nodes(s) if o.parent_path == 'r'
+                ],
+                [('r.2', 'r.7500'), ('r.0', 'r.8333'), ('r.1', 'r.9166')]
+            )
+
+    def test_move_many_full_gap(self):
+        self.tree_builder.set_digits(2,1)
+        self.tree_builder.populate(1,3, path_chooser=two_digit_paths)
+        with Session(self.engine, future=True) as s:
+            nodes = self.tree_builder.all_nodes(s)[1:]
+            # No room between r.00 and r.01 without a rebalance.
+            Node.move_many(s, [(nodes[2], 'r.00'), (nodes[1], 'r.00')])
+            s.commit()
+            self.assertEqual(
+                [o.node_name for o in self.tree_builder.all_nodes(s)],
+                ['r', 'r.0', 'r.2', 'r.1']
+            )
+
+    def test_move_many_rebalance_updates_siblings(self):
+        '''
+        Siblings renumbered by a rebalance should not keep stale paths.
+        '''
+        self.tree_builder.set_digits(2,1)
+        self.tree_builder.populate(2,2, path_chooser=two_digit_paths)
+        with Session(self.engine, future=True) as s:
+            nodes = {o.node_name: o for o in self.tree_builder.all_nodes(s)}
+            sibling = nodes['r.0.1']
+            # No room between r.00.00 and r.00.01: r.00's children are
+            # renumbered, including r.00.01 which isn't being moved.
+            Node.move_many(s, [(nodes['r.1.0'], 'r.00.00'), (nodes['r.1.1'], 'r.00.00')])
+            s.flush()
+            self.assertEqual(
+                sibling.path,
+                s.execute(select(Node.path).where(Node.id == sibling.id)).scalar_one()
+            )
+            self.assertEqual(
+                s.execute(
+                    select(Node.node_name).where(
+                        func.subpath(Node.path, 0, -1) == Ltree('r.00')
+                    ).order_by(Node.path)
+                ).scalars().all(),
+                ['r.0.0', 'r.1.0', 'r.1.1', 'r.0.1']
+            )
+
+    def test_free_paths(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(1,3)
+        with Session(self.engine, future=True) as s:
+            self.assertEqual(
+                [str(p) for p in Node.free_paths(s, 'r.2500', 4)],
+                ['r.3000', 'r.3500', 'r.4000', 'r.4500']
+            )
+            self.assertEqual(
+                [str(p) for p in Node.free_paths(s, 'r.__FIRST__', 1)],
+                ['r.1249']
+            )
+            self.assertEqual(
+                [str(p) for p in Node.free_paths(s, 'r.__LAST__', 2)],
+                ['r.8333', 'r.9166']
+            )
+
+    def test_free_paths_rebalance(self):
+        self.tree_builder.set_digits(2,1)
+        self.tree_builder.populate(1,3, path_chooser=two_digit_paths)
+        with Session(self.engine, future=True) as s:
+            paths = [str(p) for p in Node.free_paths(s, 'r.00', 2)]
+            # r.00, r.01, r.02 spread through the window [0, 11] to r.02, r.08,
+            # r.10, leaving room after r.02.
+            self.assertEqual(paths, ['r.04', 'r.06'])
+
     def test_previous_next_sibling(self):
         self.tree_builder.set_digits(4,2)
         self.tree_builder.populate(1,3)
@@ -263,6 +727,26 @@ class OLtreeMixin(DBBase):
             self.assertIs(middle.next_sibling, last)
             self.assertIs(last.next_sibling, None)
 
+    def test_sibling_path_expressions(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,3)
+        with Session(self.engine, future=True) as s:
+            rows = s.execute(
+                select(
+                    Node.path, Node.previous_sibling_path, Node.next_sibling_path
+                ).where(
+                    func.subpath(Node.path, 0, -1) == Ltree('r')
+                ).order_by(Node.path)
+            ).all()
+            self.assertEqual(
+                [tuple(str(p) if p else None for p in row) for row in rows],
+                [
+                    ('r.2500', None, 'r.5000'),
+                    ('r.5000', 'r.2500', 'r.7500'),
+                    ('r.7500', 'r.5000', None),
+                ]
+            )
+
     def test_previous_sibling_path_getter(self):
         self.tree_builder.set_digits(4,2)
         self.tree_builder.populate(1,3)
@@ -295,3 +779,600 @@ class OLtreeMixin(DBBase):
             self.assertIs(middle.previous_sibling, last)
             self.assertIs(middle.next_sibling, None)
             s.rollback()
+
+    def test_name_path_expression(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,2)
+        with Session(self.engine, future=True) as s:
+            node = s.execute(
+                select(Node).where(Node.name_path == 'r/r.1/r.1.0')
+            ).scalar_one()
+            self.assertEqual(node.path, Ltree('r.6666.3333'))
+
+    def test_with_name_paths(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,2)
+        with Session(self.engine, future=True) as s:
+            rows = Node.with_name_paths(s, 'r.3333')
+            self.assertEqual(
+                [(o.node_name, name_path) for o, name_path in rows],
+                [
+                    ('r.0', 'r/r.0'),
+                    ('r.0.0', 'r/r.0/r.0.0'),
+                    ('r.0.1', 'r/r.0/r.0.1'),
+                ]
+            )
+            for o, name_path in rows:
+                self.assertEqual(o.name_path, name_path)
+
+
+@unittest.skipIf(debugging, 'debugging')
+class Populate(DBBase):
+    def test_populate_bulk_matches_populate(self):
+        '''
+        Bulk population should produce the same tree as populate().
+        '''
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,3)
+        expected = [(o.node_name, str(o.path)) for o in self.tree_builder.all_nodes()]
+        Base.metadata.drop_all(self.engine)
+        Base.metadata.create_all(self.engine)
+        self.tree_builder.populate_bulk(2, 3, batch_size=5)
+        self.assertEqual(
+            [(o.node_name, str(o.path)) for o in self.tree_builder.all_nodes()],
+            expected
+        )
+
+    def test_populate_cached_matches_free_path(self):
+        '''
+        Cached allocation should give the same paths as oltree_free_path,
+        including when the gap runs out and the database has to rebalance.
+        '''
+        self.tree_builder.set_digits(2,1)
+        self.tree_builder.populate(
+            1, 12, path_chooser=self.tree_builder.path_chooser_free_path
+        )
+        expected = [str(o.path) for o in self.tree_builder.all_nodes()]
+        Base.metadata.drop_all(self.engine)
+        Base.metadata.create_all(self.engine)
+        self.tree_builder.populate(
+            1, 12, path_chooser=self.tree_builder.path_chooser_cached
+        )
+        self.assertEqual(
+            [str(o.path) for o in self.tree_builder.all_nodes()], expected
+        )
+
+    def test_allocator_next_ordinal(self):
+        allocator = ltree_models.OrdinalAllocator(
+            self.Node, max_digits=2, step_digits=1
+        )
+        self.assertEqual(
+            [allocator.next_ordinal(last) for last in (None, 50, 85, 97, 98, 99)],
+            [50, 60, 92, 98, 99, None]
+        )
+
+    def test_allocator_add_after_other_writer(self):
+        '''
+        Should fall back to free_path() when another session took the cached
+        slot.
+        '''
+        self.tree_builder.set_digits(2,1)
+        allocator = ltree_models.OrdinalAllocator(
+            self.Node, max_digits=2, step_digits=1
+        )
+        with Session(self.engine, future=True) as s1, Session(self.engine, future=True) as s2:
+            s1.add(self.Node(node_name='r', path=Ltree('r')))
+            s1.commit()
+            a = allocator.add(s1, self.Node(node_name='a'), 'r')
+            self.assertEqual(str(a.path), 'r.50')
+            # The next cached slot is r.60: take it in another session.
+            s2.add(self.Node(node_name='other', path=Ltree('r.60')))
+            s2.commit()
+            b = allocator.add(s1, self.Node(node_name='b'), 'r')
+            self.assertEqual(str(b.path), 'r.70')
+            s1.commit()
+        self.assertEqual(
+            [(o.node_name, str(o.path)) for o in self.tree_builder.all_nodes()],
+            [('r', 'r'), ('a', 'r.50'), ('other', 'r.60'), ('b', 'r.70')]
+        )
+
+    def test_iter_nodes_matches_all_nodes(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,3)
+        expected = [(o.node_name, str(o.path)) for o in self.tree_builder.all_nodes()]
+        self.assertEqual(
+            [(o.node_name, str(o.path)) for o in self.tree_builder.iter_nodes(batch_size=4)],
+            expected
+        )
+        with Session(self.engine, future=True) as s:
+            rows = Node.iter_subtree(
+                s, path=Ltree('r.5000'), columns=['node_name', 'path'], batch_size=2
+            )
+            self.assertEqual(
+                [(name, str(path)) for name, path in rows],
+                [row for row in expected if row[1].startswith('r.5000')]
+            )
+
+    def test_populate_bulk_rejects_db_path_chooser(self):
+        with self.assertRaises(ValueError):
+            self.tree_builder.populate_bulk(
+                1, 3, path_chooser=self.tree_builder.path_chooser_free_path
+            )
+
+
+@unittest.skipIf(debugging, 'debugging')
+class TreeSnapshot(DBBase):
+    def test_matches_database(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(2,3)
+        snapshot = self.tree_builder.snapshot()
+        self.assertEqual(len(snapshot), 13)
+        with Session(self.engine, future=True) as s:
+            for o in s.execute(select(Node)).scalars():
+                self.assertEqual(snapshot.node(o.path).id, o.id)
+                self.assertEqual(snapshot.subtree_size(o.path), o.subtree_size())
+                self.assertEqual(
+                    [n.path for n in snapshot.descendants(o.path)],
+                    [d.path for d in o.descendants()]
+                )
+                self.assertEqual(
+                    [n.path for n in snapshot.ancestors(o.path)],
+                    [a.path for a in o.ancestors]
+                )
+
+    def test_structure(self):
+        snapshot = ltree_models.TreeSnapshot([
+            ('r', 1, 'r'), ('r.1', 2, 'a'), ('r.1.1', 3, 'a1'),
+            ('r.2', 4, 'b'), ('r.2.5.6', 5, 'gap'), ('s', 6, 's'),
+        ])
+        names = lambda nodes: [n.node_name for n in nodes]
+        self.assertEqual(names(snapshot.roots()), ['r', 's'])
+        self.assertEqual(names(snapshot.children_of('r')), ['a', 'b'])
+        self.assertEqual(names(snapshot.siblings('r.1')), ['b'])
+        self.assertEqual(names(snapshot.descendants('r', max_depth=1)), ['a', 'b'])
+        # A node whose parent isn't loaded hangs off its nearest ancestor.
+        self.assertEqual(names(snapshot.ancestors('r.2.5.6')), ['r', 'b'])
+        self.assertEqual(snapshot.depth('r.2.5.6'), 4)
+        self.assertEqual(snapshot.subtree_size('r'), 5)
+        self.assertTrue(snapshot.is_ancestor('r', 'r.1.1'))
+        self.assertFalse(snapshot.is_ancestor('r.1', 'r.2'))
+        self.assertIs(snapshot.parent('s'), None)
+        self.assertNotIn('r.3', snapshot)
+        with self.assertRaises(KeyError):
+            snapshot.node('r.3')
+
+    def test_index_after_changes(self):
+        snapshot = ltree_models.TreeSnapshot([
+            ('r', 1, 'r'), ('r.1', 2, 'a'), ('r.1.1', 3, 'a1'),
+            ('r.2', 4, 'b'), ('r.2.5.6', 5, 'gap'), ('s', 6, 's'),
+        ])
+        changed = snapshot.copy()
+        changed.insert_node('r.0', 7, 'first')
+        changed.move_subtrees([('r.1', 's.1'), ('r.2', 'r.1')])
+        changed.remove_subtree('r.0')
+        for i in range(len(changed)):
+            self.assertEqual(changed.index(changed.path_at(i)), i)
+        self.assertEqual(
+            [str(changed.path_at(i)) for i in range(len(changed))],
+            ['r', 'r.1', 'r.1.5.6', 's', 's.1', 's.1.1']
+        )
+        self.assertNotIn('r.2', changed)
+        self.assertNotIn('r.0', changed)
+        # The original is untouched.
+        self.assertEqual(snapshot.node('r.2').node_name, 'b')
+
+
+@unittest.skipIf(debugging, 'debugging')
+class ChangeFeed(DBBase):
+    def setUp(self):
+        super().setUp()
+        ltree_models.add_change_feed(self.engine, full_table_name='oltree_nodes')
+        self.cache = ltree_models.SnapshotCache(self.engine, Node)
+        self.addCleanup(self.drop_log)
+
+    def drop_log(self):
+        with self.engine.begin() as con:
+            con.execute(text(f'DROP TABLE {self.cache.log_name}'))
+
+    def assertCacheCurrent(self):
+        with Session(self.engine, future=True) as s:
+            expected = ltree_models.TreeSnapshot.load(s, Node)
+        snapshot = self.cache.snapshot
+        self.assertEqual(
+            [snapshot.node_at(i) for i in range(len(snapshot))],
+            [expected.node_at(i) for i in range(len(expected))]
+        )
+        self.assertEqual(list(snapshot.sizes), list(expected.sizes))
+
+    def test_apply_changes(self):
+        self.tree_builder.set_digits(4,2)
+        self.cache.load()
+        self.tree_builder.populate(2,3)
+        self.assertEqual(self.cache.refresh(), 13)
+        self.assertCacheCurrent()
+        with Session(self.engine, future=True) as s:
+            first = s.execute(select(Node).where(Node.path==Ltree('r.2500'))).scalar_one()
+            last = s.execute(select(Node).where(Node.path==Ltree('r.7500'))).scalar_one()
+            # A subtree move is one event, however many rows it rewrites.
+            first.previous_sibling_path = last.path
+            s.commit()
+            self.assertEqual(self.cache.refresh(), 1)
+            self.assertCacheCurrent()
+            last.node_name = 'renamed'
+            Node.move_many(s, [(last, 'r.__FIRST__'), (first, 'r.__FIRST__')])
+            s.commit()
+            self.cache.refresh()
+            self.assertCacheCurrent()
+            s.execute(
+                sqlalchemy.delete(Node).where(
+                    Node.path.op('<@', is_comparison=True)(first.path)
+                ).execution_options(synchronize_session=False)
+            )
+            s.commit()
+            self.assertEqual(self.cache.refresh(), 1)
+            self.assertCacheCurrent()
+
+    def test_reload_when_needed(self):
+        self.tree_builder.set_digits(4,2)
+        self.tree_builder.populate(1,3)
+        self.cache.load()
+        with Session(self.engine, future=True) as s:
+            # Deleting a parent but not its children can't be applied.
+            s.execute(sqlalchemy.delete(Node).where(Node.path == Ltree('r')))
+            s.commit()
+        self.assertIs(self.cache.refresh(), None)
+        self.assertCacheCurrent()
+
+
+@unittest.skipIf(debugging, 'debugging')
+class Importers(DBBase):
+    tree = {
+        'name': 'root', 'children': [
+            {'name': 'a', 'children': [{'name': 'a1'}, {'name': 'a2'}]},
+            {'name': 'b'},
+        ]
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.importer = ltree_models.OLtreeImporter(
+            self.engine, Node, max_digits=4, step_digits=2
+        )
+
+    def imported(self):
+        return [(o.node_name, str(o.path)) for o in self.tree_builder.all_nodes()]
+
+    def test_import_nested(self):
+        self.assertEqual(self.importer.import_nested(self.tree, batch_size=2), 5)
+        self.assertEqual(self.imported(), [
+            ('root', '0100'),
+            ('a', '0100.0100'),
+            ('a1', '0100.0100.0100'),
+            ('a2', '0100.0100.0200'),
+            ('b', '0100.0200'),
+        ])
+
+    def test_import_json_matches_nested(self):
+        self.importer.import_nested(self.tree)
+        expected = self.imported()
+        Base.metadata.drop_all(self.engine)
+        Base.metadata.create_all(self.engine)
+        self.importer.import_json(io.BytesIO(json.dumps(self.tree).encode()))
+        self.assertEqual(self.imported(), expected)
+
+    def test_import_csv(self):
+        self.tree_builder.populate(0, 0)
+        data = io.StringIO(
+            'id,parent_id,name\n'
+            '1,,a\n'
+            '2,,b\n'
+            '3,1,a1\n'
+        )
+        self.importer.import_csv(data, parent_path='r')
+        self.assertEqual(self.imported(), [
+            ('r', 'r'),
+            ('a', 'r.0100'),
+            ('a1', 'r.0100.0100'),
+            ('b', 'r.0200'),
+        ])
+
+    def test_import_csv_depth_first(self):
+        data = (
+            'id,parent_id,name\n'
+            '1,,a\n'
+            '3,1,a1\n'
+            '4,3,a1x\n'
+            '5,1,a2\n'
+            '2,,b\n'
+        )
+        self.importer.import_csv(io.StringIO(data), depth_first=True)
+        self.assertEqual(self.imported(), [
+            ('a', '0100'),
+            ('a1', '0100.0100'),
+            ('a1x', '0100.0100.0100'),
+            ('a2', '0100.0200'),
+            ('b', '0200'),
+        ])
+        records = [(None, '1', 'a'), ('1', '2', 'a1'), ('1', '3', 'a2'), ('2', '4', 'late')]
+        with self.assertRaises(ValueError):
+            list(self.importer.paths_from_parents(records, depth_first=True))
+        self.assertEqual(len(list(self.importer.paths_from_parents(records))), 4)
+
+    def test_import_after_existing_children(self):
+        self.tree_builder.populate(0, 0)
+        self.importer.import_nested({'name': 'a'}, parent_path='r')
+        self.importer.import_nested([{'name': 'b'}, {'name': 'c'}], parent_path='r')
+        self.importer.import_csv(io.StringIO('id,parent_id,name\n1,,d\n'), parent_path='r')
+        self.importer.import_nested({'name': 's'})
+        self.importer.import_nested({'name': 't'})
+        self.assertEqual(self.imported(), [
+            ('s', '0100'),
+            ('t', '0200'),
+            ('r', 'r'),
+            ('a', 'r.0100'),
+            ('b', 'r.0200'),
+            ('c', 'r.0300'),
+            ('d', 'r.0400'),
+        ])
+
+
+@unittest.skipIf(debugging, 'debugging')
+class NamePathMixin(DBBase):
+    def setUp(self):
+        super().setUp()
+        ltree_models.add_name_path_triggers(self.engine, table_name='named_nodes')
+        self.named_builder = ltree_models.OLtreeBuilder(
+            self.engine, NamedNode, max_digits=4, step_digits=2
+        )
+        self.named_builder.populate(2, 2)
+
+    def test_insert(self):
+        with Session(self.engine, future=True) as s:
+            node = NamedNode.get_by_name_path(s, 'r/r.1/r.1.0')
+            self.assertEqual(node.path, Ltree('r.6666.3333'))
+            self.assertEqual(
+                [(o.name_path, name_path) for o, name_path in NamedNode.with_name_paths(s)],
+                [(o.name_path, o.name_path) for o in self.named_builder.all_nodes(s)]
+            )
+
+    def test_rename(self):
+        with Session(self.engine, future=True) as s:
+            node = NamedNode.get_by_name_path(s, 'r/r.1')
+            node.node_name = 'renamed'
+            s.commit()
+            self.assertEqual(node.name_path, 'r/renamed')
+            self.assertIsNone(NamedNode.get_by_name_path(s, 'r/r.1/r.1.0'))
+            self.assertEqual(
+                NamedNode.get_by_name_path(s, 'r/renamed/r.1.0').path,
+                Ltree('r.6666.3333')
+            )
+
+    def test_move(self):
+        with Session(self.engine, future=True) as s:
+            node = NamedNode.get_by_name_path(s, 'r/r.1')
+            node.set_new_path(Ltree('r.3333.5000'))
+            s.commit()
+            self.assertEqual(
+                NamedNode.get_by_name_path(s, 'r/r.0/r.1/r.1.1').path,
+                Ltree('r.3333.5000.6666')
+            )
+
+
+@unittest.skipIf(debugging, 'debugging')
+class Indexes(DBBase):
+    def setUp(self):
+        super().setUp()
+        ltree_models.LtreeBuilder(self.engine, LNode).populate(2, 3)
+
+    def assertUsesIndex(self, query, index_name):
+        with Session(self.engine, future=True) as s:
+            self.assertIn(index_name, self.explain(s, query))
+
+    def assertRelationshipUsesIndex(self, path, relationship, index_name):
+        with Session(self.engine, future=True) as s:
+            node = s.execute(
+                select(LNode).where(LNode.path == Ltree(path))
+            ).scalar_one()
+            self.assertIn(index_name, self.explain(
+                s, select(LNode).where(with_parent(node, relationship))
+            ))
+
+    def test_ancestors_use_gist(self):
+        self.assertRelationshipUsesIndex(
+            'r.0.1', LNode.ancestors, 'ltree_nodes_path_idx'
+        )
+
+    def test_parent_uses_path_key(self):
+        self.assertRelationshipUsesIndex(
+            'r.0.1', LNode.parent, 'ltree_nodes_path_key'
+        )
+
+    def test_children_use_parent_path_index(self):
+        self.assertRelationshipUsesIndex(
+            'r.0', LNode.children, 'ltree_nodes_parent_path_idx'
+        )
+
+    def test_set_new_path_uses_gist(self):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument
+            if statement.lstrip().startswith('UPDATE'):
+                statements.append((statement, parameters))
+
+        with Session(self.engine, future=True) as s:
+            node = s.execute(
+                select(LNode).where(LNode.path == Ltree('r.0'))
+            ).scalar_one()
+            s.execute(text('SET LOCAL enable_seqscan = off'))
+            connection = s.connection()
+            event.listen(connection, 'before_cursor_execute', capture)
+            try:
+                node.set_new_path(Ltree('r.9'))
+            finally:
+                event.remove(connection, 'before_cursor_execute', capture)
+            statement, parameters = statements[0]
+            plan = '\n'.join(
+                row[0] for row in connection.exec_driver_sql(
+                    'EXPLAIN ' + statement, parameters
+                )
+            )
+            s.rollback()
+        self.assertIn('ltree_nodes_path_idx', plan)
+
+    def test_subtree_uses_gist(self):
+        self.assertUsesIndex(
+            select(LNode).where(
+                LNode.path.op('<@', is_comparison=True)(Ltree('r.0'))
+            ),
+            'ltree_nodes_path_idx'
+        )
+
+    def test_descendants_use_gist(self):
+        self.assertUsesIndex(
+            select(LNode).where(LNode.descendants_of(Ltree('r'), max_depth=2)),
+            'ltree_nodes_path_idx'
+        )
+
+    def test_level_uses_nlevel_index(self):
+        self.assertUsesIndex(
+            select(LNode).where(func.nlevel(LNode.path) == 2),
+            'ltree_nodes_nlevel_idx'
+        )
+
+    def test_prefix_uses_text_index(self):
+        self.assertUsesIndex(
+            select(LNode).where(LNode.path_text_startswith('r.1')),
+            'ltree_nodes_path_text_idx'
+        )
+
+    def test_siblings_use_btree(self):
+        self.assertUsesIndex(
+            Node.next_sibling_path_query(literal(Ltree('r.5000'), LtreeType)),
+            'oltree_nodes_path_key'
+        )
+        self.assertUsesIndex(
+            Node.previous_sibling_path_query(literal(Ltree('r.5000'), LtreeType)),
+            'oltree_nodes_path_key'
+        )
+
+
+@unittest.skipIf(debugging, 'debugging')
+class LtreeMixin(DBBase):
+    def test_move_many_swap(self):
+        ltree_models.LtreeBuilder(self.engine, LNode).populate(2, 2)
+        with Session(self.engine, future=True) as s:
+            a = s.execute(select(LNode).where(LNode.path==Ltree('r.0.0'))).scalar_one()
+            b = s.execute(select(LNode).where(LNode.path==Ltree('r.1.0'))).scalar_one()
+            LNode.move_many(s, [(a, 'r.1'), (b, 'r.0')])
+            s.commit()
+            self.assertEqual((a.path, b.path), (Ltree('r.1.0'), Ltree('r.0.0')))
+            self.assertEqual((a.node_name, b.node_name), ('r.0.0', 'r.1.0'))
+
+
+@unittest.skipIf(debugging, 'debugging')
+class FLtreeMixin(DBBase):
+    def setUp(self):
+        super().setUp()
+        with Session(self.engine, future=True) as s:
+            s.add(FNode(node_name='r', path=Ltree('r')))
+            s.commit()
+
+    def add_children(self, s, parent_path, names):
+        for name in names:
+            s.add(FNode(
+                node_name=name, path=FNode.free_path(s, f'{parent_path}.__LAST__')
+            ))
+            s.flush()
+
+    def child_names(self, s, parent_path='r'):
+        return [
+            o.node_name for o in s.execute(
+                select(FNode).where(
+                    FNode.parent_path == literal(Ltree(parent_path), LtreeType)
+                ).order_by(FNode.path)
+            ).scalars()
+        ]
+
+    def test_insert_between_and_compact(self):
+        with Session(self.engine, future=True) as s:
+            self.add_children(s, 'r', ['a', 'b'])
+            a = s.execute(select(FNode).where(FNode.node_name=='a')).scalar_one()
+            self.assertEqual(str(a.path), 'r.a0')
+            # Always inserting straight after a: no gap ever runs out.
+            for i in range(100):
+                s.add(FNode(node_name=f'x{i}', path=FNode.free_path(s, a.path)))
+                s.flush()
+            expected = ['a'] + [f'x{i}' for i in reversed(range(100))] + ['b']
+            self.assertEqual(self.child_names(s), expected)
+            x0 = s.execute(select(FNode).where(FNode.node_name=='x0')).scalar_one()
+            self.add_children(s, x0.path, ['x0.child'])
+            self.assertGreater(
+                max(len(o.path[-1].path) for o in s.execute(select(FNode)).scalars()), 4
+            )
+            self.assertEqual(
+                [str(p) for p in FNode.compact_long_labels(s, max_length=4)], ['r']
+            )
+            s.commit()
+            self.assertEqual(self.child_names(s), expected)
+            self.assertTrue(all(
+                len(o.path[-1].path) <= 3 for o in s.execute(select(FNode)).scalars()
+            ))
+            child = s.execute(select(FNode).where(FNode.node_name=='x0.child')).scalar_one()
+            self.assertEqual(child.parent, x0)
+
+    def test_reorder(self):
+        with Session(self.engine, future=True) as s:
+            self.add_children(s, 'r', ['a', 'b', 'c'])
+            a, b, c = [
+                s.execute(select(FNode).where(FNode.node_name==name)).scalar_one()
+                for name in ('a', 'b', 'c')
+            ]
+            c.previous_sibling_path = 'r.__FIRST__'
+            self.assertEqual(self.child_names(s), ['c', 'a', 'b'])
+            FNode.move_many(s, [(a, 'r.__LAST__'), (c, 'r.__LAST__')])
+            s.commit()
+            self.assertEqual(self.child_names(s), ['b', 'a', 'c'])
+            self.assertEqual(b.next_sibling, a)
+            self.assertEqual(c.previous_sibling, a)
+
+
+@unittest.skipIf(debugging, 'debugging')
+class AsyncOLtreeMixin(DBBase, unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.async_engine = create_async_engine(
+            db.url().replace('postgresql://', 'postgresql+asyncpg://', 1),
+            future=True
+        )
+        self.tree_builder.set_digits(4,2)
+
+    async def asyncTearDown(self):
+        await self.async_engine.dispose()
+
+    async def test_populate_and_navigate(self):
+        async with AsyncSession(self.async_engine, future=True) as s:
+            await self.tree_builder.apopulate(s, 1, 3)
+            nodes = await self.tree_builder.aall_nodes(s)
+            self.assertEqual(
+                [str(o.path) for o in nodes], ['r', 'r.2500', 'r.5000', 'r.7500']
+            )
+            _, first, middle, last = nodes
+            self.assertIs(await first.aprevious_sibling(), None)
+            self.assertIs(await middle.aprevious_sibling(), first)
+            self.assertIs(await middle.anext_sibling(), last)
+            self.assertEqual(await nodes[0].asubtree_size(), 4)
+
+    async def test_move_to(self):
+        async with AsyncSession(self.async_engine, future=True) as s:
+            await self.tree_builder.apopulate(s, 2, 3)
+            _, first, middle, last = [
+                o for o in await self.tree_builder.aall_nodes(s) if len(o.path) <= 2
+            ]
+            await first.amove_to(middle.path)
+            self.assertIs(await first.aprevious_sibling(), middle)
+            self.assertIs(await first.anext_sibling(), last)
+            await middle.amove_to(Ltree('r.__LAST__'))
+            self.assertIs(await middle.aprevious_sibling(), last)
+            self.assertEqual(
+                [o.node_name for o in await middle.adescendants()],
+                ['r.1.0', 'r.1.1', 'r.1.2']
+            )